@@ -1,12 +1,242 @@
 import streamlit as st
-import json
-import requests
-from generate import GenerateEmail
-import pandas
+from batch import dataset_action, DEFAULT_CONCURRENCY
+from cache import get_cache
+from metrics import get_metrics
+from local_checks import POLICIES, JUDGE_POLICY, JUDGE_SAMPLE
+import os
+from dataset_store import DATA_DIR, dataset_path, dataset_version, read_dataset, save_upload, server_dataset_path
+from pipeline import RunningAverages, results_page, filter_results, flatten_results, record_from_row
+from jobs import get_job_runner, stored_job, streamed_job
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- CONFIG ---
 st.set_page_config(page_title="AI Email Editor", page_icon="📧", layout="wide")
 
+def format_scores(email_data):
+    return (
+        f"Faithfulness\n"
+        f"Rating: {email_data['faithfulness_rating'].get('rating', 0)}\n"
+        f"Reasoning: {email_data['faithfulness_rating'].get('reasoning', '')}\n\n"
+        f"Completeness\n"
+        f"Rating: {email_data['completeness_rating'].get('rating', 0)}\n"
+        f"Reasoning: {email_data['completeness_rating'].get('reasoning', '')}"
+    )
+
+def format_record_scores(res):
+    scores = ""
+    for metric in ["faithfulness", "completeness"]:
+        rating = res.get(metric, {}).get('rating')
+        scores += (
+            f"{metric.capitalize()}\n"
+            f"Rating: {'-' if rating is None else rating}\n"
+            f"Reasoning: {res.get(metric, {}).get('reasoning', '')}\n\n"
+        )
+    checks = res.get("local_checks")
+    if checks:
+        scores += (
+            f"Local checks\n"
+            f"Length ratio: {checks['length_ratio']:.2f}{'' if checks['on_target'] else ' (off target)'}\n"
+            f"Token overlap: {checks['token_overlap']:.2f}\n"
+            f"Greeting kept: {'yes' if checks['greeting_kept'] else 'no'} · Closing kept: {'yes' if checks['closing_kept'] else 'no'}"
+            + (f"\nFlagged: {checks['failure']}" if checks.get('failure') else "")
+        )
+    return scores.rstrip()
+
+def show_summary(summary, judge_policy):
+    # ratings left as None by the judge policy are skipped by the averages rather than counted as 0
+    st.subheader("Average Scores of Evaluation (0-3 Scale)")
+    faithfulness_col, completeness_col = st.columns(2)
+    faithfulness_col.metric(label="Faithfulness", value=f"{summary['faithfulness']:.2f}")
+    completeness_col.metric(label="Completeness", value=f"{summary['completeness']:.2f}")
+    st.caption(f"{summary['judged']}/{summary['records']} records scored (judge policy: {judge_policy})")
+
+    st.subheader("Local Checks")
+    ratio_col, target_col, overlap_col, flagged_col = st.columns(4)
+    ratio_col.metric("Length ratio", f"{summary['length_ratio']:.2f}")
+    target_col.metric("On length target", f"{summary['on_target']:.0%}")
+    overlap_col.metric("Token overlap", f"{summary['token_overlap']:.2f}")
+    flagged_col.metric("Flagged locally", summary["flagged"])
+
+RESULT_COLUMNS = ["id", "user_instruction", "faithfulness.rating", "completeness.rating", "local_checks.length_ratio",
+                  "local_checks.failure", "original_email", "edited_email"]
+RESULTS_PAGE_SIZE = 50
+
+# a page is read once per results file version and filter set; a new mtime/size means a fresh read
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_results_page(path, version, page, filters):
+    return results_page(path, page, RESULTS_PAGE_SIZE, **filters)
+
+def show_results_table(run, key):
+    # one paginated table instead of a widget per record; file-backed runs are read a chunk at a time
+    ratings = ["0", "1", "2", "3", "None"]
+    faithfulness_col, completeness_col, flagged_col, search_col = st.columns(4)
+    filters = {
+        "faithfulness": faithfulness_col.multiselect("Faithfulness", ratings, key=f"{key}_faithfulness"),
+        "completeness": completeness_col.multiselect("Completeness", ratings, key=f"{key}_completeness"),
+        "flagged_only": flagged_col.checkbox("Flagged locally only", key=f"{key}_flagged"),
+        "search": search_col.text_input("Search id or text", key=f"{key}_search"),
+    }
+
+    def page_of(page):
+        if "path" in run:
+            version = dataset_version(run["path"]) if os.path.exists(run["path"]) else None
+            return load_results_page(run["path"], version, page, filters)
+        matching = filter_results(flatten_results(run["records"]), **filters)
+        return matching.iloc[page * RESULTS_PAGE_SIZE:(page + 1) * RESULTS_PAGE_SIZE], len(matching)
+
+    page = st.session_state.get(f"{key}_page", 1)
+    frame, matches = page_of(page - 1)
+    pages = max(1, -(-matches // RESULTS_PAGE_SIZE))
+    if page > pages:
+        # the filters shrank the result set below the current page
+        page = st.session_state[f"{key}_page"] = pages
+        frame, matches = page_of(page - 1)
+
+    st.number_input(f"Page (of {pages}, {matches} matching records)", min_value=1, max_value=pages, key=f"{key}_page")
+    columns = [column for column in RESULT_COLUMNS if column in frame]
+    selection = st.dataframe(frame[columns], hide_index=True, width="stretch", on_select="rerun",
+                             selection_mode="single-row", key=f"{key}_table")
+    rows = [row for row in selection.selection.rows if row < len(frame)]
+    if rows:
+        res = record_from_row(frame.iloc[rows[0]])
+        st.markdown(f"Email ID: {res['id']}")
+        original_col, edited_col, scores_col = st.columns(3)
+        original_col.text_area("Original Email", value=res.get('original_email', ''), height=200, key=f"{key}_original")
+        edited_col.text_area("Edited Email", value=res.get('edited_email', ''), height=200, key=f"{key}_edited")
+        scores_col.text_area("Scores of Evaluation", value=format_record_scores(res), height=200, key=f"{key}_scores")
+    else:
+        st.caption("Select a row to see the full emails and the judge's reasoning.")
+
+def show_run_metrics(run_id):
+    import pandas
+    from rate_limit import get_rate_controller
+    from clients import connection_stats
+    summary = get_metrics().summary(run_id)
+    with st.expander("Run metrics"):
+        calls_col, hits_col, latency_col, tokens_col, cost_col = st.columns(5)
+        calls_col.metric("API calls", summary["api_calls"])
+        hits_col.metric("Cache hits", summary["cache_hits"])
+        latency_col.metric("Latency p50 / p95", f"{summary['p50_latency']:.2f}s / {summary['p95_latency']:.2f}s")
+        tokens_col.metric("Tokens in / out", f"{summary['prompt_tokens']} / {summary['completion_tokens']}")
+        cost_col.metric("Estimated cost", f"${summary['cost']:.4f}")
+        st.caption(f"Errors: {summary['errors']} · Retries: {summary['retries']} · "
+                   f"Shared with identical requests: {summary['coalesced']} · Prompt-cached input tokens: "
+                   f"{summary['cached_tokens']} ({summary['prefix_cache_rate']:.0%})")
+        if summary["by_prompt"]:
+            st.dataframe(pandas.DataFrame.from_dict(summary["by_prompt"], orient="index").rename_axis("Prompt"))
+        limits = get_rate_controller().stats()
+        if limits:
+            st.caption("Rate controller: " + " · ".join(
+                f"{model}: {state['concurrency_limit']} concurrent, {state['rate_limited']} rate-limited"
+                for model, state in limits.items()
+            ))
+        connections = connection_stats()
+        st.caption(f"HTTP connections (all sessions): {connections['requests']} requests over "
+                   f"{connections['connections']} connections, {connections['reuse_rate']:.0%} reused")
+
+# --- BACKGROUND JOBS ---
+# seconds between polls of a running job
+JOB_POLL_SECONDS = 1.0
+
+def job_panel(job_id, was_active, key):
+    job = get_job_runner().get(job_id)
+    if job is None:
+        return
+    if was_active and not job.active:
+        # finished since the last poll: rerun the page so the results below are drawn
+        st.rerun()
+    state = job.snapshot()
+    phase = f" · {state['phase']}" if state["phase"] else ""
+    st.progress(state["done"]/state["total"] if state["total"] else 0.0,
+                text=f"{state['label']}: {state['status']} · {state['done']}/{state['total']} emails{phase} · "
+                     f"{state['elapsed']:.0f}s")
+    if job.active:
+        if st.button("Cancel", key=f"{key}_cancel_{job_id}", disabled=state["status"] == "cancelling"):
+            job.cancel()
+    elif state["status"] in ("cancelled", "failed"):
+        if state["error"]:
+            st.error(state["error"])
+        if st.button("Resume", key=f"{key}_resume_{job_id}", help="Evaluate the emails this job has not finished yet."):
+            get_job_runner().resume(job_id)
+            st.rerun()
+    if job.active and state["recent"]:
+        summary = state["summary"]
+        faithfulness_col, completeness_col, ratio_col, flagged_col = st.columns(4)
+        faithfulness_col.metric("Faithfulness (so far)", f"{summary['faithfulness']:.2f}")
+        completeness_col.metric("Completeness (so far)", f"{summary['completeness']:.2f}")
+        ratio_col.metric("Length ratio (so far)", f"{summary['length_ratio']:.2f}")
+        flagged_col.metric("Flagged locally (so far)", summary["flagged"])
+        latest = flatten_results(state["recent"][::-1])
+        st.dataframe(latest[[column for column in RESULT_COLUMNS if column in latest]], hide_index=True, width="stretch")
+
+def show_job(job_id, key):
+    # polled in a fragment, so only the job panel reruns while the job is in progress
+    job = get_job_runner().get(job_id)
+    if job is None:
+        st.info("This job is no longer available.")
+        return None
+    st.fragment(job_panel, run_every=JOB_POLL_SECONDS if job.active else None)(job_id, job.active, key)
+    return job
+
+def job_run(job):
+    # what the results views show: everything for a finished job, what was done so far otherwise
+    if job.active:
+        return None
+    if not job.keep_records:
+        return job.result
+    records = job.result if job.status == "done" else job.partial_records()
+    averages = RunningAverages()
+    averages.update(records)
+    return {"records": records, "summary": averages.summary()}
+
+# --- DATASETS ---
+# parsed once per file version and shared by every session; a new mtime/size means a fresh parse
+@st.cache_resource(max_entries=16, show_spinner=False)
+def load_dataset(path, version):
+    return read_dataset(path)
+
+def get_dataset(name):
+    path = dataset_path(name)
+    return load_dataset(path, dataset_version(path))
+
+# --- SIDEBAR: RESPONSE CACHE AND RESULTS STORE ---
+with st.sidebar:
+    st.subheader("Response Cache")
+    use_cache = st.checkbox("Use cached responses", value=get_cache() is not None, disabled=get_cache() is None,
+                            help="Serve repeated requests (same model, prompt and settings) from the on-disk cache.")
+    cache_stats_placeholder = st.empty()
+    if get_cache() is not None and st.button("Clear cache"):
+        get_cache().clear()
+
+    st.subheader("Results Store")
+    reuse_results = st.checkbox("Reuse results from earlier runs", value=True,
+                                help="Generate and Compare only evaluate emails whose content or prompts changed since they were last run.")
+
+    st.subheader("Judging")
+    judge_policy = st.selectbox("Judge policy", options=POLICIES, index=POLICIES.index(JUDGE_POLICY),
+                                help="all: judge every edit. skip_failures: empty, unchanged or wrong-length edits are "
+                                     "scored by the local checks without a judge call. sample: also judge only a "
+                                     "fraction of the remaining edits.")
+    judge_sample = st.slider("Judge sample", min_value=0.05, max_value=1.0, value=JUDGE_SAMPLE, step=0.05,
+                             disabled=judge_policy != "sample")
+
+    st.subheader("Jobs")
+    jobs_active = any(job.active for job in get_job_runner().jobs())
+
+    @st.fragment(run_every=JOB_POLL_SECONDS if jobs_active else None)
+    def jobs_list():
+        jobs = get_job_runner().jobs()
+        if not jobs:
+            st.caption("Generate and Compare runs show up here and keep running in the background.")
+        for job in jobs:
+            state = job.snapshot()
+            label_col, show_col = st.columns([3, 1])
+            label_col.caption(f"{state['label']} · {state['status']} · {state['done']}/{state['total']}")
+            if show_col.button("Show", key=f"show_job_{job.id}"):
+                st.session_state[f"{job.kind}_job"] = job.id
+                st.rerun()
+    jobs_list()
+
 # 3 tabs
 edit_email_tab, generate_tab, analysis_tab = st.tabs(["Edit emails", "Generate", "View Analysis"])
 
@@ -16,27 +246,18 @@ with edit_email_tab:
     st.write("Select an email record by ID and use AI to refine it.")
 
     selected_dataset_edit = st.selectbox("Select Dataset", options=["lengthen.jsonl", "shorten.jsonl", "tone.jsonl"], key="dataset_edit")
-    dataset_path_edit = "datasets/" + selected_dataset_edit
-    emails = []
-    with open(dataset_path_edit, "r") as fh:     
-        for line in fh:
-            emails.append(json.loads(line))
-    if not emails:
+    dataset_edit = get_dataset(selected_dataset_edit)
+    if not dataset_edit.records:
         st.warning("No emails found in your JSONL file.")
         st.stop()
 
     selected_model_edit = st.selectbox("Select Model", options=["gpt-4o-mini", "gpt-4.1"], index=0, key="model_edit")
 
     # --- ID NAVIGATION BAR ---
-    email_ids = [email.get('id') for email in emails]
-    selected_id = st.selectbox("📂 Select Email ID", options=email_ids, index=0)
+    selected_id = st.selectbox("📂 Select Email ID", options=dataset_edit.ids, index=0)
 
     # Find the selected email
-    selected_email = None
-    for email in emails:
-        if email.get("id") == selected_id:
-            selected_email = email
-            break
+    selected_email = dataset_edit.get(selected_id)
 
     if not selected_email:
         st.error(f"No email found with ID {selected_id}.")
@@ -67,183 +288,142 @@ with edit_email_tab:
     if edited_email_key not in st.session_state:
         st.session_state[edited_email_key] = selected_email_data["edited_email"]
 
-    generator = GenerateEmail(model=selected_model_edit)
-
     # Display buttons
+    pending_edit = None
     column1, column2, column3 = st.columns(3)
     with column1:
         if st.button("Elaborate", key=f"lengthen_{selected_id}"):
-            selected_email_data["user_instruction"] = "lengthen"
-            edited = generator.generate("lengthen", email_text)
-            selected_email_data["edited_email"] = edited
-            st.session_state[f"edited_email_{selected_id}"] = edited
-
-            selected_email_data["faithfulness_rating"] = generator.judge_faithfulness(email_text, selected_email_data["edited_email"])
-            selected_email_data["completeness_rating"] = generator.judge_completeness(selected_email_data["user_instruction"], email_text, selected_email_data["edited_email"])
-
-            st.session_state.email_data[email_key] = selected_email_data
-            # st.rerun()
+            pending_edit = ("lengthen", "lengthen", {})
     with column2:
         if st.button("Shorten", key=f"shorten_{selected_id}"):
-            selected_email_data["user_instruction"] = "shorten"
-            edited = generator.generate("shorten", email_text)
-            selected_email_data["edited_email"] = edited
-            st.session_state[f"edited_email_{selected_id}"] = edited
-
-            selected_email_data["faithfulness_rating"] = generator.judge_faithfulness(email_text, selected_email_data["edited_email"])
-            selected_email_data["completeness_rating"] = generator.judge_completeness(selected_email_data["user_instruction"], email_text, selected_email_data["edited_email"])
-
-            st.session_state.email_data[email_key] = selected_email_data
-            # st.rerun()
+            pending_edit = ("shorten", "shorten", {})
     with column3:
         selected_tone = st.selectbox("Change Tone", ("Select a Tone", "Friendly", "Sympathetic", "Professional"), key=f"change_tone_{selected_id}")
-        if selected_tone != "Select a Tone":
-                selected_email_data["user_instruction"] = f"change_tone_{selected_tone.lower()}"
-                edited = generator.generate(f"change_tone", email_text, tone=selected_tone.lower())
-                selected_email_data["edited_email"] = edited
-                st.session_state[f"edited_email_{selected_id}"] = edited
-
-                selected_email_data["faithfulness_rating"] = generator.judge_faithfulness(email_text, selected_email_data["edited_email"])
-                selected_email_data["completeness_rating"] = generator.judge_completeness(selected_email_data["user_instruction"], email_text, selected_email_data["edited_email"])
-
-                st.session_state.email_data[email_key] = selected_email_data
-
+        # only re-run when the tone selection changes, not on every rerun while a tone is selected
+        if selected_tone != "Select a Tone" and selected_tone != selected_email_data.get("applied_tone"):
+            pending_edit = ("change_tone", f"change_tone_{selected_tone.lower()}", {"tone": selected_tone.lower()})
+        selected_email_data["applied_tone"] = selected_tone
+
+    edited_email_area = st.empty()
+    scores_area = st.empty()
+
+    if pending_edit:
+        # imported on the first edit rather than at startup, which keeps a fresh worker's first render fast
+        from generate import GenerateEmail
+        generator = GenerateEmail(model=selected_model_edit, use_cache=use_cache)
+        action, user_instruction, generate_kwargs = pending_edit
+        selected_email_data["user_instruction"] = user_instruction
+
+        # show tokens as they arrive, then swap in the editable text area below
+        with edited_email_area.container():
+            st.markdown("**Edited Email**")
+            edited = st.write_stream(generator.generate(action, email_text, stream=True, **generate_kwargs))
+        selected_email_data["edited_email"] = edited
+        st.session_state[edited_email_key] = edited
+
+        # judges only need the finished edit, run them concurrently and fill in scores as they land
+        selected_email_data["faithfulness_rating"] = {"rating": "…", "reasoning": "Evaluating…"}
+        selected_email_data["completeness_rating"] = {"rating": "…", "reasoning": "Evaluating…"}
+        edited_email_area.text_area("Edited Email", height=250, key=edited_email_key)
+        scores_area.code(format_scores(selected_email_data), language=None)
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            if generator.fused_judge:
+                futures = {pool.submit(generator.judge_both, user_instruction, email_text, edited): None}
+            else:
+                futures = {
+                    pool.submit(generator.judge_faithfulness, email_text, edited): "faithfulness_rating",
+                    pool.submit(generator.judge_completeness, user_instruction, email_text, edited): "completeness_rating"
+                }
+            for future in as_completed(futures):
+                if futures[future] is None:
+                    selected_email_data["faithfulness_rating"] = future.result()["faithfulness"]
+                    selected_email_data["completeness_rating"] = future.result()["completeness"]
+                else:
+                    selected_email_data[futures[future]] = future.result()
+                scores_area.code(format_scores(selected_email_data), language=None)
 
-    edited_email = st.text_area("Edited Email", height=250, key=f"edited_email_{selected_id}")
-    # value=st.session_state.get(f"edited_email_{selected_id}", "")
+        st.session_state.email_data[email_key] = selected_email_data
+    else:
+        edited_email_area.text_area("Edited Email", height=250, key=edited_email_key)
 
     selected_email_data = st.session_state.email_data[email_key]
 
-    st.text_area(
-        "Scores of Evaluation", 
-        value=(
-            f"Faithfulness\n"
-            f"Rating: {selected_email_data['faithfulness_rating'].get('rating', 0)}\n"
-            f"Reasoning: {selected_email_data['faithfulness_rating'].get('reasoning', '')}\n\n"
-            f"Completeness\n"
-            f"Rating: {selected_email_data['completeness_rating'].get('rating', 0)}\n"
-            f"Reasoning: {selected_email_data['completeness_rating'].get('reasoning', '')}"
-        ),
-        height=250
-    )
+    scores_area.text_area("Scores of Evaluation", value=format_scores(selected_email_data), height=250)
 
 with generate_tab:
     st.title("Generate")
     st.write("Run a model on all emails in a dataset")
 
-    selected_dataset_gen = st.selectbox("Select Dataset", options=["lengthen.jsonl", "shorten.jsonl", "tone.jsonl"], key="dataset_gen")
-    dataset_path_gen = "datasets/" + selected_dataset_gen
-    emails_gen = []
-    with open(dataset_path_gen, "r") as fh:     
-        for line in fh:
-            emails_gen.append(json.loads(line))
-    if not emails_gen:
-        st.warning("No emails found in your JSONL file.")
-        st.stop()
+    source_gen = st.radio("Dataset source", options=["Bundled dataset", "Upload", "File path"], horizontal=True,
+                          key="source_gen")
+    actions = ["lengthen", "shorten", "change_tone"]
+    dataset_path_gen = None
+    if source_gen == "Bundled dataset":
+        selected_dataset_gen = st.selectbox("Select Dataset", options=["lengthen.jsonl", "shorten.jsonl", "tone.jsonl"], key="dataset_gen")
+        emails_gen = get_dataset(selected_dataset_gen).records
+        if not emails_gen:
+            st.warning("No emails found in your JSONL file.")
+            st.stop()
+        apply_action = dataset_action(selected_dataset_gen)
+    else:
+        if source_gen == "Upload":
+            upload = st.file_uploader("Upload a JSONL or Parquet dataset", type=["jsonl", "parquet"], key="upload_gen")
+            if upload is not None:
+                # copied to disk once per upload; the copy is what gets streamed and resumed
+                uploads = st.session_state.setdefault("uploads", {})
+                if upload.file_id not in uploads:
+                    uploads[upload.file_id] = save_upload(upload.name, upload)
+                dataset_path_gen = uploads[upload.file_id]
+        else:
+            requested_path = st.text_input(f"Dataset path under {DATA_DIR}", key="path_gen",
+                                           help="A JSONL or Parquet file too large to upload through the browser. "
+                                                "Only files under EMAIL_DATA_DIR can be read.")
+            # anything outside the data directory is refused, so the app cannot read arbitrary server files
+            dataset_path_gen = server_dataset_path(requested_path) if requested_path else None
+            if requested_path and dataset_path_gen is None:
+                st.warning(f"No such file under {DATA_DIR}: {requested_path}")
+        name = os.path.basename(dataset_path_gen) if dataset_path_gen else ""
+        implied_action = dataset_action(name) if dataset_action(name) in actions else "shorten"
+        apply_action = st.selectbox("Action", options=actions, index=actions.index(implied_action), key="action_gen")
 
     selected_model_gen = st.selectbox("Select Model", options=["gpt-4o-mini", "gpt-4.1"], index=0, key="model_gen")
 
-    if st.button("Generate"):
-        # st.write(f"Processing all {len(emails_gen)} email records in {selected_dataset_gen}")
-
-        apply_action = ""
-        if selected_dataset_gen == "lengthen.jsonl":
-            apply_action = "lengthen"
-        elif selected_dataset_gen == "shorten.jsonl":
-            apply_action = "shorten"
-        elif selected_dataset_gen == "tone.jsonl":
-            apply_action = "change_tone"
-            tones = ["friendly", "sympathetic", "professional"]
-        
-        generator = GenerateEmail(model=selected_model_gen)
-        
-        # Progress bar
-        progress_bar = st.progress(0, text=f"Processed 0/{len(emails_gen)} email records")
-
-        results = []
-        faithfulness_scores = []
-        completeness_scores = []
-        for index, email in enumerate(emails_gen):
-            email_text_gen = email.get("content", "")
-            if apply_action == "change_tone":
-                for select_tone in tones:
-                    user_instruction_gen = f"change_tone_{select_tone}"
-                    edited_gen = generator.generate("change_tone", email_text_gen, tone=select_tone)
-
-                    faithfulness_gen = generator.judge_faithfulness(email_text_gen, edited_gen)
-                    completeness_gen = generator.judge_completeness(user_instruction_gen, email_text_gen, edited_gen)
-                    faithfulness_scores.append(faithfulness_gen.get('rating', 0))
-                    completeness_scores.append(completeness_gen.get('rating', 0))
-
-                    results.append({
-                        "id": f"{email.get('id')}_{select_tone}", 
-                        "original_email": email_text_gen,
-                        "edited_email": edited_gen,
-                        "faithfulness": faithfulness_gen,
-                        "completeness": completeness_gen, 
-                        "user_instruction": user_instruction_gen
-                    })
-
-            else:
-                user_instruction_gen = apply_action
-                edited_gen = generator.generate(user_instruction_gen, email_text_gen)
-
-                faithfulness_gen = generator.judge_faithfulness(email_text_gen, edited_gen)
-                completeness_gen = generator.judge_completeness(user_instruction_gen, email_text_gen, edited_gen)
-
-                faithfulness_scores.append(faithfulness_gen.get('rating', 0))
-                completeness_scores.append(completeness_gen.get('rating', 0))
-
-                results.append({
-                    "id": email.get("id"), 
-                    "original_email": email_text_gen,
-                    "edited_email": edited_gen,
-                    "faithfulness": faithfulness_gen,
-                    "completeness": completeness_gen, 
-                    "user_instruction": user_instruction_gen
-                })
-            # Update progress bar
-            progress_bar.progress((index + 1)/len(emails_gen), text=f"Processed {index + 1}/{len(emails_gen)} emails")  
-
-        st.write(f"Finished processing {len(emails_gen)} email records in {selected_dataset_gen}!")
-
-        st.markdown("---")
-        st.subheader("Average Scores of Evaluation (0-3 Scale)")
-
-        avg_faithfulness_score = sum(faithfulness_scores)/len(faithfulness_scores) if len(faithfulness_scores) > 0 else 0
-        avg_completeness_score = sum(completeness_scores)/len(completeness_scores) if len(completeness_scores) > 0 else 0
-        
-        faithfulness_col, completeness_col = st.columns(2)
-        with faithfulness_col:
-            st.metric(label="Faithfulness", value=f"{avg_faithfulness_score:.2f}")
-        with completeness_col:
-            st.metric(label="Completeness", value=f"{avg_completeness_score:.2f}")
-
-        st.markdown("---")
-        st.subheader("Individual Model Responses and Scores")
-        for i, res in enumerate(results):
-            # st.markdown("---")
-            st.markdown(f"Email ID: {res['id']}")
-            
-            # Display original and edited emails
-            original_col, edited_col, scores_col = st.columns(3)
-            with original_col:
-                st.text_area("Original Email", value=res['original_email'], height=200, key=f"original_{res['id']}_{i}")
-            with edited_col:
-                st.text_area("Edited Email", value=res['edited_email'], height=200, key=f"edited_{res['id']}_{i}")
-            with scores_col:
-                st.text_area(
-                    "Scores of Evaluation", 
-                    value=(
-                        f"Faithfulness\n"
-                        f"Rating: {res['faithfulness'].get('rating', 0)}\n"
-                        f"Reasoning: {res['faithfulness'].get('reasoning', '')}\n\n"
-                        f"Completeness\n"
-                        f"Rating: {res['completeness'].get('rating', 0)}\n"
-                        f"Reasoning: {res['completeness'].get('reasoning', '')}"
-                    ),
-                    height=200
-                )
+    concurrency_gen = st.number_input("Max concurrent requests", min_value=1, max_value=64, value=DEFAULT_CONCURRENCY, key="concurrency_gen")
+
+    if st.button("Generate", disabled=source_gen != "Bundled dataset" and dataset_path_gen is None):
+        # runs in the background, so using other widgets or tabs meanwhile does not stop it
+        generator_options = {"use_cache": use_cache, "judge_policy": judge_policy, "judge_sample": judge_sample}
+        if source_gen == "Bundled dataset":
+            job_gen = get_job_runner().submit(
+                "generate", f"{selected_dataset_gen} · {selected_model_gen}", stored_job,
+                dataset=selected_dataset_gen, action=apply_action, models=[selected_model_gen],
+                concurrency=concurrency_gen, reuse=reuse_results, generator_options=generator_options
+            )
+        else:
+            job_gen = get_job_runner().submit(
+                "generate", f"{os.path.basename(dataset_path_gen)} · {selected_model_gen}", streamed_job,
+                keep_records=False, path=dataset_path_gen, action=apply_action, model=selected_model_gen,
+                concurrency=concurrency_gen, generator_options=generator_options
+            )
+        st.session_state.generate_job = job_gen.id
+
+    if "generate_job" in st.session_state:
+        job_gen = show_job(st.session_state.generate_job, "generate")
+        run_gen = job_gen and job_run(job_gen)
+        if run_gen:
+            st.write(f"{'Finished' if job_gen.status == 'done' else 'Partial results:'} {run_gen['summary']['records']} "
+                     f"email records in {job_gen.label}")
+            if "path" in run_gen:
+                st.caption(f"Results file: {run_gen['path']}")
+            show_run_metrics(job_gen.id)
+
+            st.markdown("---")
+            show_summary(run_gen["summary"], job_gen.params["generator_options"]["judge_policy"])
+
+            st.markdown("---")
+            st.subheader("Individual Model Responses and Scores")
+            show_results_table(run_gen, f"results_{job_gen.id}")
 
 with analysis_tab:
     st.title("Model Comparison")
@@ -256,101 +436,76 @@ with analysis_tab:
         selected_dataset_scores = "shorten.jsonl"
     elif selected_instruction == "Change Tone":
         selected_dataset_scores = "tone.jsonl"
-        tones = ["friendly", "sympathetic", "professional"]
-    dataset_path_scores = "datasets/" + selected_dataset_scores
-
-    emails_scores = []
-    with open(dataset_path_scores, "r") as fh:     
-        for line in fh:
-            emails_scores.append(json.loads(line))
+    selected_action = dataset_action(selected_dataset_scores)
+    emails_scores = get_dataset(selected_dataset_scores).records
     if not emails_scores:
         st.warning("No emails found in your JSONL file.")
         st.stop()
 
+    concurrency_scores = st.number_input("Max concurrent requests", min_value=1, max_value=64, value=DEFAULT_CONCURRENCY, key="concurrency_scores")
+
     if st.button("Compare"):
-        # st.write(f"Processing all {len(emails_scores)} email records in {selected_dataset_scores}")
-
-        combined_results = {}
-        for model_name in ["gpt-4o-mini", "gpt-4.1"]:
-            # st.write(f"Running {model_name}")
-            generator = GenerateEmail(model=model_name)
-
-            # Progress bar for each model
-            progress_bar = st.progress(0, text=f"Processed 0/{len(emails_scores)} emails using {model_name}")
-
-            model_results = []
-            faithfulness_scores = []
-            completeness_scores = []
-            for i, email in enumerate(emails_scores):
-                email_text = email.get("content", "")
-                if selected_instruction == "Change Tone":
-                    for select_tone in tones:
-                        user_instruction = f"change_tone_{select_tone}"
-                        edited = generator.generate("change_tone", email_text, tone=select_tone)
-
-                        faithfulness = generator.judge_faithfulness(email_text, edited)
-                        completeness = generator.judge_completeness(user_instruction, email_text, edited)
-                        faithfulness_scores.append(faithfulness.get('rating', 0))
-                        completeness_scores.append(completeness.get('rating', 0))
-
-                        model_results.append({
-                            "id": f"{email.get('id')}_{select_tone}", 
-                            "original_email": email_text,
-                            "edited_email": edited,
-                            "faithfulness": faithfulness,
-                            "completeness": completeness, 
-                            "user_instruction": user_instruction,
-                            "model": model_name
-                        })
-                
-                else:
-                    edited = generator.generate(selected_instruction.lower(), email_text)
-
-                    faithfulness = generator.judge_faithfulness(email_text, edited)
-                    completeness = generator.judge_completeness(selected_instruction.lower(), email_text, edited)
-                    faithfulness_scores.append(faithfulness.get('rating', 0))
-                    completeness_scores.append(completeness.get('rating', 0))
-
-                    model_results.append({
-                        "id": f"{email.get('id')}", 
-                        "original_email": email_text,
-                        "edited_email": edited,
-                        "faithfulness": faithfulness,
-                        "completeness": completeness, 
-                        "user_instruction": selected_instruction.lower(),
-                        "model": model_name
-                    })
-                
-                if model_name == "gpt-4o-mini":
-                    progress_bar.progress((i + 1)/len(emails_scores), text=f"Processed {i + 1}/{len(emails_scores)} emails using GPT-4o mini")
-                else:
-                     progress_bar.progress((i + 1)/len(emails_scores), text=f"Processed {i + 1}/{len(emails_scores)} emails using GPT-4.1")
-
-            avg_faithfulness = sum(faithfulness_scores)/len(faithfulness_scores) if len(faithfulness_scores) > 0 else 0
-            avg_completeness = sum(completeness_scores)/len(completeness_scores) if len(completeness_scores) > 0 else 0
-            
-            combined_results[model_name] = {"results": model_results, "faithfulness": avg_faithfulness, "completeness": avg_completeness}
-            # st.subheader(f"{model_name}")
-            # st.write(f"\tAverage Faithfulness: {avg_faithfulness:.2f}")
-            # st.write(f"\tAverage Completeness: {avg_completeness:.2f}")
+        # only emails whose content or prompts changed since the last stored run are sent to the API
+        job_scores = get_job_runner().submit(
+            "compare", f"Compare · {selected_dataset_scores}", stored_job,
+            dataset=selected_dataset_scores, action=selected_action, models=["gpt-4o-mini", "gpt-4.1"],
+            concurrency=concurrency_scores, reuse=reuse_results,
+            generator_options={"use_cache": use_cache, "judge_policy": judge_policy, "judge_sample": judge_sample}
+        )
+        st.session_state.compare_job = job_scores.id
+
+    job_scores = show_job(st.session_state.compare_job, "compare") if "compare_job" in st.session_state else None
+    run_scores = job_scores and job_run(job_scores)
+    if run_scores and run_scores["records"]:
+        import pandas
+        model_labels = {"gpt-4o-mini": "GPT-4o mini", "gpt-4.1": "GPT-4.1"}
+        compared_records = run_scores["records"]
+        if job_scores.status != "done":
+            st.caption(f"Partial results: {len(compared_records)} records evaluated before the job stopped.")
+        show_run_metrics(job_scores.id)
+
+        scores_frame = pandas.json_normalize(compared_records)
+        # unjudged (None) ratings become NaN and drop out of the means
+        averages = (
+            scores_frame[["faithfulness.rating", "completeness.rating"]]
+            .apply(pandas.to_numeric, errors="coerce")
+            .groupby(scores_frame["model"]).mean()
+            .reindex(list(model_labels)).fillna(0)
+        )
+        local_columns = ["local_checks.length_ratio", "local_checks.on_target", "local_checks.token_overlap"]
+        local_averages = (
+            scores_frame.reindex(columns=local_columns).astype(float)
+            .assign(flagged=scores_frame.reindex(columns=["local_checks.failure"]).squeeze(axis=1).notna())
+            .groupby(scores_frame["model"]).agg({**dict.fromkeys(local_columns, "mean"), "flagged": "sum"})
+            .reindex(list(model_labels))
+        )
         
         st.markdown("---")
         st.subheader("Model Scores")
-        scores_table = {
-            "Model": ["GPT-4o mini", "GPT-4.1"],
-            "Faithfulness": [f"{combined_results['gpt-4o-mini']['faithfulness']:.2f}", f"{combined_results['gpt-4.1']['faithfulness']:.2f}"],
-            "Completeness": [f"{combined_results['gpt-4o-mini']['completeness']:.2f}", f"{combined_results['gpt-4.1']['completeness']:.2f}"],
-        }
-        st.table(scores_table)
+        scores_table = pandas.DataFrame({
+            "Model": [model_labels[model_name] for model_name in averages.index],
+            "Faithfulness": averages["faithfulness.rating"].map("{:.2f}".format).values,
+            "Completeness": averages["completeness.rating"].map("{:.2f}".format).values,
+            "Length ratio": local_averages["local_checks.length_ratio"].map("{:.2f}".format).values,
+            "On length target": local_averages["local_checks.on_target"].map("{:.0%}".format).values,
+            "Token overlap": local_averages["local_checks.token_overlap"].map("{:.2f}".format).values,
+            "Flagged locally": local_averages["flagged"].fillna(0).astype(int).values,
+        })
+        st.table(scores_table.set_index("Model"))
 
         st.markdown("---")
         st.subheader("Comparison Chart")
         comparison_data = pandas.DataFrame({
             "Model": ["GPT-4o mini", "GPT-4.1", None, "GPT-4o mini", "GPT-4.1"],
             "Metric": ["Faithfulness (GPT-4o mini)","Faithfulness (GPT-4.1)", "", "Completeness (GPT-4o mini)", "Completeness (GPT-4.1)"],
-            "Score": [combined_results['gpt-4o-mini']['faithfulness'], combined_results['gpt-4.1']['faithfulness'], 0, combined_results['gpt-4o-mini']['completeness'], combined_results['gpt-4.1']['completeness']]
+            "Score": [averages.loc['gpt-4o-mini', 'faithfulness.rating'], averages.loc['gpt-4.1', 'faithfulness.rating'], 0, averages.loc['gpt-4o-mini', 'completeness.rating'], averages.loc['gpt-4.1', 'completeness.rating']]
         })
         st.bar_chart(data=comparison_data[comparison_data["Model"].notna()], x="Metric", y="Score", color="Model", x_label="Score (0-3)", y_label="Metric", horizontal=True, sort=False, height=400)
 
-        
-        
\ No newline at end of file
+# filled in last so the counters include every call made during this run
+if get_cache() is not None:
+    cache_stats = get_cache().stats()
+    cache_stats_placeholder.caption(
+        f"Hits: {cache_stats['hits']} · Misses: {cache_stats['misses']} · "
+        f"Hit rate: {cache_stats['hit_rate']:.0%} · Entries: {cache_stats['entries']}"
+    )
@@ -0,0 +1,229 @@
+import asyncio
+import os
+import queue
+from local_checks import apply_checks
+
+TONES = ["friendly", "sympathetic", "professional"]
+
+# max number of API calls in flight at once, shared by generation and judge calls
+DEFAULT_CONCURRENCY = int(os.getenv("EMAIL_BATCH_CONCURRENCY", "8"))
+
+
+def dataset_action(dataset_name: str) -> str:
+    # lengthen.jsonl -> lengthen, shorten.jsonl -> shorten, tone.jsonl -> change_tone
+    if dataset_name.startswith("tone"):
+        return "change_tone"
+    return dataset_name.split(".")[0]
+
+
+def email_tasks(email: dict, action: str):
+    """Expand one email into (record id, user instruction, generate kwargs) tuples."""
+    if action == "change_tone":
+        return [(f"{email.get('id')}_{tone}", f"change_tone_{tone}", {"tone": tone}) for tone in TONES]
+    return [(email.get("id"), action, {})]
+
+
+def pending_emails(emails, action, done_ids):
+    """Emails with at least one record id missing from `done_ids` (a set of str ids)."""
+    return [
+        email for email in emails
+        if not all(str(record_id) in done_ids for record_id, _, _ in email_tasks(email, action))
+    ]
+
+
+# emails per pipeline chunk: each chunk is generated, checked locally as a whole, then judged
+CHUNK_SIZE = int(os.getenv("EMAIL_BATCH_CHUNK_SIZE", "32"))
+
+
+async def _limited(semaphore, make):
+    # the coroutine is only created once a slot is free, so a cancelled run leaves none un-awaited
+    async with semaphore:
+        return await make()
+
+
+async def _once(generator, memo, key, prompt_name, make):
+    """Await the one shared call for `key` in this run, starting it if this is the first request."""
+    if memo is None:
+        return await make()
+    if key in memo:
+        generator._record_coalesced(generator.deployment_name, prompt_name)
+    else:
+        memo[key] = asyncio.ensure_future(make())
+    return await memo[key]
+
+
+def _new_record(generator, email_text, record_id, user_instruction, edited):
+    return {
+        "id": record_id,
+        "original_email": email_text,
+        "edited_email": edited,
+        "faithfulness": None,
+        "completeness": None,
+        "user_instruction": user_instruction,
+        "model": generator.deployment_name
+    }
+
+
+async def _generate_record(generator, semaphore, memo, email, action, record_id, user_instruction, kwargs):
+    email_text = email.get("content", "")
+    # datasets repeat email bodies; each distinct (action, text, tone) is generated once per run
+    edited = await _once(generator, memo, ("generate", action, email_text, tuple(sorted(kwargs.items()))), action,
+                         lambda: _limited(semaphore, lambda: generator.agenerate(action, email_text, **kwargs)))
+    return _new_record(generator, email_text, record_id, user_instruction, edited)
+
+
+async def _generate_email(generator, semaphore, memo, email, action):
+    """The records of one email; with tone fan-out, every tone comes from a single request."""
+    tasks = email_tasks(email, action)
+    if action != "change_tone" or not generator.tone_fanout:
+        return await asyncio.gather(*(
+            _generate_record(generator, semaphore, memo, email, action, record_id, user_instruction, kwargs)
+            for record_id, user_instruction, kwargs in tasks
+        ))
+    email_text = email.get("content", "")
+    tones = tuple(kwargs["tone"] for _, _, kwargs in tasks)
+    variants = await _once(generator, memo, ("variants", email_text, tones), "change_tone_variants",
+                           lambda: _limited(semaphore, lambda: generator.agenerate_variants(email_text, tones)))
+    return [
+        _new_record(generator, email_text, record_id, user_instruction, variants[kwargs["tone"]])
+        for record_id, user_instruction, kwargs in tasks
+    ]
+
+
+async def _judge_record(generator, semaphore, memo, record):
+    instruction = record["user_instruction"]
+    args = (record["original_email"], record["edited_email"])
+    if generator.fused_judge:
+        judgement = await _once(generator, memo, ("fused_judge", instruction) + args, "fused_judge",
+                                lambda: _limited(semaphore, lambda: generator.ajudge_both(instruction, *args)))
+        record["faithfulness"] = dict(judgement["faithfulness"])
+        record["completeness"] = dict(judgement["completeness"])
+    else:
+        # both judges only depend on the edit, so run them side by side
+        faithfulness, completeness = await asyncio.gather(
+            _once(generator, memo, ("faithfulness_judge",) + args, "faithfulness_judge",
+                  lambda: _limited(semaphore, lambda: generator.ajudge_faithfulness(*args))),
+            _once(generator, memo, ("completeness_judge", instruction) + args, "completeness_judge",
+                  lambda: _limited(semaphore, lambda: generator.ajudge_completeness(instruction, *args))),
+        )
+        record["faithfulness"], record["completeness"] = dict(faithfulness), dict(completeness)
+
+
+async def _process_chunk(generator, semaphore, memo, emails, action, on_email):
+    """
+    Generate every record of the chunk and run the local checks over all of them at once. Each
+    email is then judged on its own and handed to `on_email(offset, records)` as soon as its
+    judgements land, rather than when the whole chunk is done.
+    """
+    records = await asyncio.gather(*(_generate_email(generator, semaphore, memo, email, action) for email in emails))
+    to_judge = {id(record) for record in apply_checks([record for email_records in records for record in email_records],
+                                                      generator.judge_policy, generator.judge_sample)}
+
+    async def finish(offset, email_records):
+        await asyncio.gather(*(_judge_record(generator, semaphore, memo, record)
+                               for record in email_records if id(record) in to_judge))
+        on_email(offset, email_records)
+
+    await asyncio.gather(*(finish(offset, email_records) for offset, email_records in enumerate(records)))
+
+
+async def arun_batch(emails, action, model, concurrency=DEFAULT_CONCURRENCY, on_progress=None, generator=None,
+                     on_result=None, chunk_size=CHUNK_SIZE):
+    """
+    Run generate -> local checks -> judge over every email with at most `concurrency` API calls in flight.
+
+    Emails go through in chunks of `chunk_size`, two chunks at a time, so one chunk's judge calls
+    overlap the next chunk's generations. `on_progress(done, total)` is called as soon as an email
+    (all of its variants) is judged, and `on_result(email, records)` right before it with that
+    email's records, e.g. to checkpoint them.
+    Results are returned flattened in dataset order, regardless of completion order.
+    """
+    if generator is None:
+        # generate (and openai) load on first use, so the app can import the dataset helpers cheaply
+        from generate import GenerateEmail
+        generator = GenerateEmail(model=model)
+    semaphore = asyncio.Semaphore(max(1, int(concurrency)))
+    chunk_size = max(1, int(chunk_size))
+    # in-batch dedup: request key -> the task computing it, for the whole run (off with coalescing)
+    memo = {} if generator.flight is not None else None
+    results = [None] * len(emails)
+    done = 0
+
+    pending = iter(range(0, len(emails), chunk_size))
+
+    async def worker():
+        nonlocal done
+        for start in pending:
+            chunk = emails[start:start + chunk_size]
+
+            def finish(offset, records, start=start, chunk=chunk):
+                nonlocal done
+                results[start + offset] = records
+                done += 1
+                if on_result:
+                    on_result(chunk[offset], records)
+                if on_progress:
+                    on_progress(done, len(emails))
+
+            await _process_chunk(generator, semaphore, memo, chunk, action, finish)
+
+    await asyncio.gather(worker(), worker())
+    return [record for email_records in results for record in email_records]
+
+
+def run_batch(emails, action, model, concurrency=DEFAULT_CONCURRENCY, on_progress=None, generator=None, on_result=None):
+    """
+    Blocking arun_batch on the shared background event loop, whose connection pools stay warm
+    between runs. The callbacks still run on the calling thread (Streamlit widgets need that):
+    they are queued by the loop and drained here.
+    """
+    from clients import run_coroutine
+    calls = queue.Queue()
+
+    def relay(callback):
+        return callback and (lambda *args: calls.put((callback, args)))
+
+    future = run_coroutine(arun_batch(emails, action, model, concurrency=concurrency, on_progress=relay(on_progress),
+                                      generator=generator, on_result=relay(on_result)))
+    future.add_done_callback(lambda _: calls.put(None))
+    try:
+        for callback, args in iter(calls.get, None):
+            callback(*args)
+    except BaseException:
+        # e.g. Streamlit stopping the script on a rerun: stop the run instead of leaving it behind
+        future.cancel()
+        raise
+    return future.result()
+
+
+def run_stored_batch(store, dataset, emails, action, model, concurrency=DEFAULT_CONCURRENCY, on_progress=None,
+                     generator=None, reuse=True, on_result=None):
+    """
+    Like run_batch, but reuse records from the results store and only evaluate emails whose
+    content, or the prompts for this action, changed since they were last stored.
+    With `reuse` off every email is evaluated again and the store is refreshed.
+    """
+    if generator is None:
+        from generate import GenerateEmail
+        generator = GenerateEmail(model=model)
+    version = generator.prompt_version(action)
+    stored = store.lookup(dataset, model, version, emails) if reuse else {}
+    missing = pending_emails(emails, action, set(stored))
+    reused = len(emails) - len(missing)
+
+    def save(email, records):
+        store.save(dataset, model, version, email, records)
+        for record in records:
+            stored[str(record["id"])] = record
+        if on_result:
+            on_result(email, records)
+
+    def report(done, total):
+        if on_progress:
+            on_progress(reused + done, len(emails))
+
+    if missing:
+        run_batch(missing, action, model, concurrency=concurrency, on_progress=report, generator=generator, on_result=save)
+    else:
+        report(0, 0)
+    return [stored[str(record_id)] for email in emails for record_id, _, _ in email_tasks(email, action)]
@@ -0,0 +1,217 @@
+"""
+Offline dataset runs through the provider Batch API.
+
+Phase 1 submits every generation request as one batch; phase 2 builds the judge batch from
+the generation outputs the judge policy keeps after the local checks (see local_checks.py).
+Results are merged back into the same record shape as the Generate tab. Batch ids are kept
+in a small state file, so an interrupted run resumes polling the batches it already
+submitted instead of paying for them twice.
+"""
+import io
+import json
+import os
+import time
+from batch import email_tasks
+from cache import cache_key
+from generate import GenerateEmail, FUSED_JUDGE_FORMAT, parse_rating
+from local_checks import apply_checks
+from metrics import get_metrics
+
+ENDPOINT = "/v1/chat/completions"
+FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def _request(custom_id, model, messages, **params):
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": ENDPOINT,
+        "body": {"model": model, "messages": messages, "temperature": 0, **params}
+    }
+
+
+def generation_requests(generator, emails, action):
+    requests = []
+    for email in emails:
+        for record_id, _, kwargs in email_tasks(email, action):
+            messages = generator._generate_messages(action, email.get("content", ""), **kwargs)
+            requests.append(_request(f"generate:{record_id}", generator.deployment_name, messages))
+    return requests
+
+
+def judge_requests(generator, records):
+    requests = []
+    for record in records:
+        if record["edited_email"] is None:
+            continue
+        args = (record["original_email"], record["edited_email"])
+        if generator.fused_judge:
+            messages = generator._fused_judge_messages(record["user_instruction"], *args)
+            requests.append(_request(f"judge:{record['id']}", generator.deployment_name, messages,
+                                     response_format=FUSED_JUDGE_FORMAT))
+        else:
+            requests.append(_request(f"faithfulness:{record['id']}", generator.deployment_name,
+                                     generator._faithfulness_messages(*args)))
+            requests.append(_request(f"completeness:{record['id']}", generator.deployment_name,
+                                     generator._completeness_messages(record["user_instruction"], *args)))
+    return requests
+
+
+def dedupe(requests):
+    """Drop requests whose body repeats an earlier one; returns (unique requests, {custom_id: first custom_id})."""
+    unique, first, aliases = [], {}, {}
+    for request in requests:
+        body = request["body"]
+        params = {name: value for name, value in body.items() if name not in ("model", "messages")}
+        key = cache_key(body["model"], body["messages"], **params)
+        if key in first:
+            aliases[request["custom_id"]] = first[key]
+        else:
+            first[key] = request["custom_id"]
+            unique.append(request)
+    return unique, aliases
+
+
+def submit(client, requests) -> str:
+    payload = "".join(json.dumps(request, ensure_ascii=False) + "\n" for request in requests)
+    input_file = client.files.create(file=("batch.jsonl", io.BytesIO(payload.encode("utf-8"))), purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint=ENDPOINT, completion_window="24h")
+    return batch.id
+
+
+def wait(client, batch_id, poll_interval=30, on_status=None):
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if on_status:
+            on_status(batch)
+        if batch.status in FINISHED_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+
+def fetch_outputs(client, batch, requests, cache=None) -> dict:
+    """Map custom_id -> response text (None for failed requests), filling the response cache on the way."""
+    bodies = {request["custom_id"]: request["body"] for request in requests}
+    outputs = {}
+    if not batch.output_file_id:
+        return outputs
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            outputs[item["custom_id"]] = None
+            continue
+        content = response["body"]["choices"][0]["message"]["content"]
+        outputs[item["custom_id"]] = content
+        usage = response["body"].get("usage") or {}
+        get_metrics().record(
+            response["body"].get("model"), "batch_" + item["custom_id"].split(":")[0],
+            prompt_tokens=usage.get("prompt_tokens", 0), completion_tokens=usage.get("completion_tokens", 0),
+            cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        )
+        body = bodies.get(item["custom_id"])
+        if cache is not None and body is not None:
+            params = {name: value for name, value in body.items() if name not in ("model", "messages")}
+            cache.set(cache_key(body["model"], body["messages"], **params), content)
+    return outputs
+
+
+class _State():
+    """Batch ids per phase, persisted so restarts pick up submitted batches."""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        if path and os.path.exists(path):
+            with open(path, "r") as fh:
+                self.data = json.load(fh)
+
+    def get(self, phase):
+        return self.data.get(phase)
+
+    def set(self, phase, batch_id):
+        self.data[phase] = batch_id
+        if self.path:
+            with open(self.path, "w") as fh:
+                json.dump(self.data, fh)
+
+    def clear(self):
+        self.data = {}
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _run_phase(client, state, phase, requests, poll_interval, on_status, cache):
+    requests, aliases = dedupe(requests)
+    if not requests:
+        return {}
+    batch_id = state.get(phase)
+    if batch_id is None:
+        batch_id = submit(client, requests)
+        state.set(phase, batch_id)
+    batch = wait(client, batch_id, poll_interval, on_status=on_status and (lambda b: on_status(phase, b)))
+    if batch.status != "completed":
+        raise RuntimeError(f"{phase} batch {batch_id} ended with status {batch.status}")
+    outputs = fetch_outputs(client, batch, requests, cache)
+    for custom_id, first in aliases.items():
+        outputs[custom_id] = outputs.get(first)
+    return outputs
+
+
+def run_batch_api(emails, action, model, generator=None, poll_interval=30, state_path=None, on_status=None):
+    """
+    Generate and judge every email through two Batch API jobs; returns (records in dataset
+    order, number of emails left out).
+
+    An email is left out when one of its generation or judge requests failed in the batch
+    (non-200 status, or reported in the error file instead of the output file), so a re-run
+    evaluates it again instead of keeping a record with no edit or no rating.
+    `on_status(phase, batch)` is called after every poll with phase "generate" or "judge".
+    """
+    generator = generator or GenerateEmail(model=model)
+    state = _State(state_path)
+
+    requests = generation_requests(generator, emails, action)
+    edits = _run_phase(generator.client, state, "generate", requests, poll_interval, on_status, generator.cache)
+
+    by_email = []
+    for email in emails:
+        email_records = [{
+            "id": record_id,
+            "original_email": email.get("content", ""),
+            "edited_email": edits.get(f"generate:{record_id}"),
+            "user_instruction": user_instruction,
+            "model": generator.deployment_name
+        } for record_id, user_instruction, _ in email_tasks(email, action)]
+        if all(record["edited_email"] is not None for record in email_records):
+            by_email.append(email_records)
+    failed = len(emails) - len(by_email)
+
+    to_judge = apply_checks([record for email_records in by_email for record in email_records],
+                            generator.judge_policy, generator.judge_sample)
+    requests = judge_requests(generator, to_judge)
+    judgements = _run_phase(generator.client, state, "judge", requests, poll_interval, on_status, generator.cache)
+
+    unjudged = set()
+    for record in to_judge:
+        if generator.fused_judge:
+            outputs = [judgements.get(f"judge:{record['id']}")]
+            judgement = generator._split_judgement(outputs[0])
+            record["faithfulness"], record["completeness"] = judgement["faithfulness"], judgement["completeness"]
+        else:
+            outputs = [judgements.get(f"faithfulness:{record['id']}"), judgements.get(f"completeness:{record['id']}")]
+            record["faithfulness"], record["completeness"] = (parse_rating(output) for output in outputs)
+        if any(output is None for output in outputs):
+            unjudged.add(record["id"])
+
+    records = []
+    for email_records in by_email:
+        if any(record["id"] in unjudged for record in email_records):
+            failed += 1
+        else:
+            records += email_records
+
+    state.clear()
+    return records, failed
@@ -0,0 +1,162 @@
+"""
+Run generate -> judge over a whole dataset without the browser.
+
+    python batch_cli.py datasets/tone.jsonl --model gpt-4o-mini --workers 4
+
+Every finished email is appended to the output as one JSON line per record (the same shape
+the Generate tab shows) and flushed straight away. Re-running the same command skips the
+emails already in the output, so an interrupted run resumes where it stopped. The default
+output is named after the dataset file, the model and the prompt version, like the app's
+streamed runs, so editing prompts.yaml starts a fresh file instead of resuming the old one. The dataset
+(JSONL or Parquet) is read --chunk-size emails at a time, so memory stays flat on large corpora.
+
+With --workers N the dataset is split round-robin across N processes. Each one appends to
+its own shard file next to the output, and the shards are folded into the output once every
+worker has finished. Use --shard I/N to run a single shard yourself, e.g. on another machine.
+
+With --mode batch-api the requests go through the provider Batch API instead (see
+batch_api.py): slower to finish, but with higher throughput limits and lower per-token cost.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+from batch import dataset_action, pending_emails, DEFAULT_CONCURRENCY
+from dataset_store import read_dataset, STREAM_CHUNK_SIZE
+from pipeline import run_streamed, drop_torn_line, result_ids, results_path
+
+
+def shard_path(output: str, shard: int, num_shards: int) -> str:
+    root, ext = os.path.splitext(output)
+    return f"{root}.shard{shard}-of-{num_shards}{ext or '.jsonl'}"
+
+
+def _shard_files(output: str):
+    root, ext = os.path.splitext(output)
+    return sorted(glob.glob(f"{glob.escape(root)}.shard*-of-*{ext or '.jsonl'}"))
+
+
+def completed_ids(output: str) -> set:
+    """Record ids already written to the output or any of its shard files."""
+    return result_ids(output, *_shard_files(output))
+
+
+def run_shard(dataset, output, model, action, concurrency, shard=0, num_shards=1, chunk_size=STREAM_CHUNK_SIZE):
+    target = output if num_shards == 1 else shard_path(output, shard, num_shards)
+    label = f"[shard {shard + 1}/{num_shards}]"
+
+    def report(done, total, averages):
+        if done == total or done % 10 == 0:
+            print(f"{label} {done}/{total}", file=sys.stderr)
+
+    averages = run_streamed(dataset, target, action, model, concurrency=concurrency, chunk_size=chunk_size,
+                            on_progress=report, shard=shard, num_shards=num_shards, done_ids=completed_ids(output))
+    summary = averages.summary()
+    print(f"{label} {summary['records']} new records · faithfulness {summary['faithfulness']:.2f} · "
+          f"completeness {summary['completeness']:.2f} · {summary['flagged']} flagged", file=sys.stderr)
+
+
+def run_batch_api_mode(dataset, output, model, action, poll_interval):
+    from batch_api import run_batch_api
+    emails = pending_emails(read_dataset(dataset).records, action, completed_ids(output))
+    print(f"{len(emails)} emails to process", file=sys.stderr)
+    if not emails:
+        return
+
+    def report(phase, batch):
+        counts = batch.request_counts
+        progress = f" {counts.completed}/{counts.total}" if counts else ""
+        print(f"[{phase} batch {batch.id}] {batch.status}{progress}", file=sys.stderr)
+
+    records, failed = run_batch_api(emails, action, model, poll_interval=poll_interval,
+                                    state_path=output + ".batch-state.json", on_status=report)
+    drop_torn_line(output)
+    with open(output, "a") as out:
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+    if failed:
+        print(f"{failed} emails had failed batch requests and were left out; re-run the same command "
+              f"to retry them", file=sys.stderr)
+
+
+def merge_shards(output):
+    # picks up shards from earlier runs with a different worker count as well
+    drop_torn_line(output)
+    with open(output, "a") as out:
+        for path in _shard_files(output):
+            with open(path, "r") as fh:
+                for line in fh:
+                    if line.endswith("\n"):
+                        out.write(line)
+            os.remove(path)
+
+
+def export_parquet(output, parquet_path):
+    import pandas
+    with open(output, "r") as fh:
+        records = [json.loads(line) for line in fh]
+    # faithfulness/completeness dicts become faithfulness.rating, faithfulness.reasoning, ...
+    pandas.json_normalize(records).to_parquet(parquet_path, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dataset", help="path to a JSONL or Parquet dataset, e.g. datasets/shorten.jsonl")
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--action", choices=["lengthen", "shorten", "change_tone"],
+                        help="defaults to the one implied by the dataset file name")
+    parser.add_argument("--output", help="JSONL results file "
+                                         "(default: results/<dataset>-<hash>-<model>-<prompt version>.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="API calls in flight per process")
+    parser.add_argument("--workers", type=int, default=1, help="split the dataset across this many processes")
+    parser.add_argument("--chunk-size", type=int, default=STREAM_CHUNK_SIZE, help="emails read and evaluated per chunk")
+    parser.add_argument("--shard", help="run only shard I of N, given as I/N (1-based)")
+    parser.add_argument("--parquet", help="also export the finished results to this Parquet file")
+    parser.add_argument("--mode", choices=["async", "batch-api"], default="async",
+                        help="call the API directly (default) or submit everything through the Batch API")
+    parser.add_argument("--poll-interval", type=float, default=30, help="seconds between Batch API status checks")
+    args = parser.parse_args()
+
+    action = args.action or dataset_action(os.path.basename(args.dataset))
+    output = args.output
+    if output is None:
+        from generate import GenerateEmail
+        # --mode batch-api always sends one request per tone, so its prompt version has no fan-out
+        options = {"tone_fanout": False} if args.mode == "batch-api" else {}
+        output = results_path(args.dataset, args.model, GenerateEmail(model=args.model, **options).prompt_version(action))
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    if args.mode == "batch-api":
+        run_batch_api_mode(args.dataset, output, args.model, action, args.poll_interval)
+    elif args.shard:
+        shard, num_shards = (int(part) for part in args.shard.split("/"))
+        run_shard(args.dataset, output, args.model, action, args.concurrency, shard - 1, num_shards, args.chunk_size)
+        return
+    elif args.workers <= 1:
+        run_shard(args.dataset, output, args.model, action, args.concurrency, chunk_size=args.chunk_size)
+    else:
+        workers = [
+            multiprocessing.Process(
+                target=run_shard,
+                args=(args.dataset, output, args.model, action, args.concurrency, shard, args.workers, args.chunk_size)
+            )
+            for shard in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if any(worker.exitcode != 0 for worker in workers):
+            sys.exit("Some workers failed; re-run the same command to resume.")
+    merge_shards(output)
+
+    if args.parquet:
+        export_parquet(output, args.parquet)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
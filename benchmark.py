@@ -0,0 +1,190 @@
+"""
+Throughput and latency benchmark for the generate -> judge pipeline, against the local mock server.
+
+    python benchmark.py --scale 1 10 --concurrency 4 16 --latency 0.3 --jitter 0.1
+    python benchmark.py --datasets tone.jsonl --rate-limit-rate 0.05 --json bench.json
+    python benchmark.py --coldstart 5
+
+Runs the lengthen/shorten/tone pipelines over the bundled datasets (optionally replicated
+--scale times) and reports records/sec, p50/p95/p99 API call latency and API calls per
+record, plus the share of input tokens served from the (simulated) provider prompt cache and
+the share of requests that reused a pooled connection.
+The response cache and request coalescing are bypassed so every run measures real round-trips.
+
+--coldstart N instead starts N fresh interpreters and times the first render of app.py, the
+way a new Streamlit worker sees it, and which heavy modules that render imported.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from mock_openai import MockOpenAIServer
+
+DATASETS = ["lengthen.jsonl", "shorten.jsonl", "tone.jsonl"]
+
+
+def scale_emails(emails, factor):
+    """Replicate a dataset `factor` times with unique ids (copies get an `-<n>` suffix)."""
+    scaled = list(emails)
+    for copy in range(1, factor):
+        scaled += [{**email, "id": f"{email.get('id')}-{copy}"} for email in emails]
+    return scaled
+
+
+def run_case(server, dataset, emails, model, concurrency, fused_judge, tone_fanout):
+    from batch import run_batch, dataset_action
+    from generate import GenerateEmail
+    from metrics import get_metrics
+    from clients import connection_stats
+
+    run_id = uuid.uuid4().hex
+    # scaled copies repeat the same emails, so coalescing would hide most of the load; the mock
+    # echoes unchanged text, which skip_failures would never send to the judge, so judge everything
+    generator = GenerateEmail(model=model, use_cache=False, fused_judge=fused_judge, run_id=run_id, coalesce=False,
+                              tone_fanout=tone_fanout, judge_policy="all")
+    server.reset_stats()
+    connections_before = connection_stats()
+
+    start = time.perf_counter()
+    error = None
+    records = []
+    try:
+        records = run_batch(emails, dataset_action(dataset), model, concurrency=concurrency, generator=generator)
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+    elapsed = time.perf_counter() - start
+    summary = get_metrics().summary(run_id)
+    connections = {name: value - connections_before[name] for name, value in connection_stats().items()
+                   if name != "reuse_rate"}
+
+    calls = server.stats["chat"] + server.stats["errors"] + server.stats["rate_limited"]
+    return {
+        "dataset": dataset,
+        "emails": len(emails),
+        "records": len(records),
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "records_per_sec": len(records) / elapsed if elapsed else 0.0,
+        "p50": summary["p50_latency"],
+        "p95": summary["p95_latency"],
+        "p99": summary["p99_latency"],
+        "calls_per_record": calls / len(records) if records else 0.0,
+        "prompt_tokens": summary["prompt_tokens"],
+        "completion_tokens": summary["completion_tokens"],
+        "cached_tokens": summary["cached_tokens"],
+        "prefix_cache_rate": summary["prefix_cache_rate"],
+        "connections_opened": connections["connections"],
+        "connection_reuse": 1 - connections["connections"] / connections["requests"] if connections["requests"] else 0.0,
+        "errors": server.stats["errors"],
+        "rate_limited": server.stats["rate_limited"],
+        "failed": error
+    }
+
+
+# run in a fresh interpreter; prints one JSON line
+_COLDSTART_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+ready = time.perf_counter()
+app = AppTest.from_file("app.py", default_timeout=60).run()
+done = time.perf_counter()
+print(json.dumps({
+    "streamlit": ready - start,
+    "first_render": done - ready,
+    "exception": bool(app.exception),
+    "imported": [name for name in ("openai", "pandas", "yaml", "pyarrow") if name in sys.modules],
+}))
+"""
+
+
+def coldstart(runs):
+    env = {**os.environ, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "mock")}
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", _COLDSTART_SCRIPT], capture_output=True, text=True, env=env,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    summary = {
+        "runs": runs,
+        "streamlit": statistics.median(result["streamlit"] for result in results),
+        "first_render": statistics.median(result["first_render"] for result in results),
+        "exception": any(result["exception"] for result in results),
+        "imported": results[-1]["imported"],
+    }
+    print(f"median over {runs} fresh interpreters: import streamlit {summary['streamlit'] * 1000:.0f} ms, "
+          f"first render of app.py {summary['first_render'] * 1000:.0f} ms")
+    print(f"heavy modules loaded by the first render: {', '.join(summary['imported']) or 'none'}"
+          + ("  (the app raised an exception)" if summary["exception"] else ""))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--datasets", nargs="+", default=DATASETS)
+    parser.add_argument("--scale", nargs="+", type=int, default=[1], help="replicate each dataset this many times")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[8])
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--two-call-judge", action="store_true", help="benchmark the two-call judge instead of the fused one")
+    parser.add_argument("--per-tone-calls", action="store_true",
+                        help="generate each tone with its own request instead of one fan-out request per email")
+    parser.add_argument("--latency", type=float, default=0.3, help="mock server mean latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--prefix-cache-min", type=int, default=1024,
+                        help="smallest system prompt the mock reports as prompt-cached, in tokens")
+    parser.add_argument("--rpm", type=int, help="have the mock enforce this requests-per-minute quota")
+    parser.add_argument("--json", help="also write the results to this file, e.g. to diff against a baseline")
+    parser.add_argument("--coldstart", type=int, metavar="N", help="only measure app.py cold start over N fresh interpreters")
+    args = parser.parse_args()
+
+    if args.coldstart:
+        summary = coldstart(args.coldstart)
+        if args.json:
+            with open(args.json, "w") as fh:
+                json.dump({"settings": vars(args), "coldstart": summary}, fh, indent=2)
+        return
+
+    server = MockOpenAIServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                              rate_limit_rate=args.rate_limit_rate, seed=args.seed,
+                              prefix_cache_min=args.prefix_cache_min, rpm=args.rpm).start()
+    # GenerateEmail reads these when it builds its clients
+    os.environ["OPENAI_API_BASE"] = server.url
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    from dataset_store import dataset_path, read_dataset
+
+    results = []
+    header = f"{'dataset':<16}{'emails':>8}{'conc':>6}{'rec/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'calls/rec':>11}{'cached':>8}{'reuse':>7}"
+    print(header)
+    print("-" * len(header))
+    try:
+        for dataset in args.datasets:
+            emails = read_dataset(dataset_path(dataset)).records
+            for factor in args.scale:
+                for concurrency in args.concurrency:
+                    result = run_case(server, dataset, scale_emails(emails, factor), args.model, concurrency,
+                                      fused_judge=not args.two_call_judge, tone_fanout=not args.per_tone_calls)
+                    results.append(result)
+                    print(
+                        f"{dataset:<16}{result['emails']:>8}{concurrency:>6}{result['records_per_sec']:>9.1f}"
+                        f"{result['p50'] * 1000:>9.0f}{result['p95'] * 1000:>9.0f}{result['p99'] * 1000:>9.0f}"
+                        f"{result['calls_per_record']:>11.2f}{result['prefix_cache_rate']:>8.0%}"
+                        f"{result['connection_reuse']:>7.0%}"
+                        + (f"  FAILED ({result['failed']})" if result["failed"] else "")
+                    )
+    finally:
+        server.stop()
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump({"settings": vars(args), "results": results}, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
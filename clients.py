@@ -0,0 +1,157 @@
+"""
+Process-wide OpenAI clients over long-lived, keep-alive HTTP connection pools.
+
+Building an OpenAI client per GenerateEmail meant a new connection pool (and new TCP/TLS
+handshakes) on every Streamlit rerun. Clients now come from this registry: one sync pool per
+endpoint, shared by every session, and one async pool per endpoint on a single background
+event loop that outlives individual batch runs (see `run_coroutine`).
+
+Every request is traced, so `connection_stats()` shows how often a pooled connection was
+reused versus newly opened.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import weakref
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# pool sizes and keep-alive expiry (seconds) for every shared HTTP client
+MAX_CONNECTIONS = int(os.getenv("EMAIL_HTTP_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE = int(os.getenv("EMAIL_HTTP_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("EMAIL_HTTP_KEEPALIVE_EXPIRY", "60"))
+# multiplex requests over HTTP/2 connections; needs the optional `h2` package
+HTTP2 = os.getenv("EMAIL_HTTP2", "").lower() in ("1", "true", "yes")
+
+
+class ConnectionStats():
+    """Requests sent versus connections (and TLS handshakes) opened, from httpcore trace events."""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.connect_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _tracer(self):
+        # one per request: times each connect/TLS step from its .started to its .complete event
+        started = []
+
+        def trace(name, info):
+            with self._lock:
+                if name == "connection.connect_tcp.started":
+                    self.connections += 1
+                    started.append(time.perf_counter())
+                elif name == "connection.start_tls.started":
+                    self.tls_handshakes += 1
+                    started.append(time.perf_counter())
+                elif name in ("connection.connect_tcp.complete", "connection.start_tls.complete") and started:
+                    self.connect_seconds += time.perf_counter() - started.pop()
+        return trace
+
+    def on_request(self, request):
+        with self._lock:
+            self.requests += 1
+        request.extensions["trace"] = self._tracer()
+
+    async def on_async_request(self, request):
+        with self._lock:
+            self.requests += 1
+        trace = self._tracer()
+
+        async def atrace(name, info):
+            trace(name, info)
+        request.extensions["trace"] = atrace
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections": self.connections,
+                "tls_handshakes": self.tls_handshakes,
+                "connect_seconds": self.connect_seconds,
+                "reuse_rate": 1 - self.connections / self.requests if self.requests else 0.0
+            }
+
+
+_stats = ConnectionStats()
+
+
+def connection_stats() -> dict:
+    return _stats.snapshot()
+
+
+def _http_options() -> dict:
+    http2 = HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("EMAIL_HTTP2 is set but the h2 package is not installed; using HTTP/1.1")
+            http2 = False
+    return {
+        "limits": httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE,
+                               keepalive_expiry=KEEPALIVE_EXPIRY),
+        "http2": http2,
+    }
+
+
+_lock = threading.Lock()
+_sync_clients = {}
+# async pools are bound to the event loop they run on, so they are kept per loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _endpoint():
+    return os.getenv("OPENAI_API_BASE"), os.getenv("OPENAI_API_KEY")
+
+
+def get_client(max_retries: int = None) -> OpenAI:
+    """The shared sync client for the configured endpoint; `max_retries` views share its pool."""
+    base_url, api_key = _endpoint()
+    with _lock:
+        key = (base_url, api_key)
+        if key not in _sync_clients:
+            http_client = DefaultHttpxClient(**_http_options(), event_hooks={"request": [_stats.on_request]})
+            _sync_clients[key] = {None: OpenAI(base_url=base_url, api_key=api_key, http_client=http_client)}
+        clients = _sync_clients[key]
+        if max_retries not in clients:
+            clients[max_retries] = clients[None].with_options(max_retries=max_retries)
+        return clients[max_retries]
+
+
+def get_async_client(max_retries: int = None, loop=None) -> AsyncOpenAI:
+    """The shared async client for the configured endpoint on `loop` (default: the running loop)."""
+    loop = loop or asyncio.get_running_loop()
+    base_url, api_key = _endpoint()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {}).setdefault((base_url, api_key), {})
+        if None not in clients:
+            http_client = DefaultAsyncHttpxClient(**_http_options(), event_hooks={"request": [_stats.on_async_request]})
+            clients[None] = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+        if max_retries not in clients:
+            clients[max_retries] = clients[None].with_options(max_retries=max_retries)
+        return clients[max_retries]
+
+
+_loop = None
+
+
+def background_loop():
+    """One event loop for every async batch run, on a daemon thread, so async pools stay warm."""
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="email-async-loop", daemon=True).start()
+        return _loop
+
+
+def run_coroutine(coro):
+    """Schedule `coro` on the background loop; returns a concurrent.futures.Future."""
+    return asyncio.run_coroutine_threadsafe(coro, background_loop())
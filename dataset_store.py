@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import tempfile
+
+DATASET_DIR = "datasets"
+# the app's "File path" source only reads datasets under this directory
+DATA_DIR = os.getenv("EMAIL_DATA_DIR", DATASET_DIR)
+# uploaded corpora are copied here, named by content hash so a re-upload resumes the same run
+UPLOAD_DIR = os.getenv("EMAIL_UPLOAD_DIR", ".cache/uploads")
+# emails read (and evaluated) per chunk when streaming a large dataset
+STREAM_CHUNK_SIZE = int(os.getenv("EMAIL_STREAM_CHUNK_SIZE", "500"))
+
+
+class Dataset():
+    """A parsed JSONL dataset with an id -> record index. Records are shared, treat them as read-only."""
+
+    def __init__(self, path: str, records: list):
+        self.path = path
+        self.records = records
+        self.ids = [record.get("id") for record in records]
+        self.by_id = {record.get("id"): record for record in records}
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, record_id):
+        return self.by_id.get(record_id)
+
+
+def dataset_path(name: str) -> str:
+    return os.path.join(DATASET_DIR, name)
+
+
+def server_dataset_path(path: str):
+    """`path` (absolute, or relative to DATA_DIR) resolved to a file inside DATA_DIR, else None."""
+    root = os.path.realpath(DATA_DIR)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root or not os.path.isfile(resolved):
+        return None
+    return resolved
+
+
+def dataset_version(path: str):
+    """Cheap change token for a dataset file, used to invalidate cached parses."""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_dataset(path: str) -> Dataset:
+    records = []
+    with open(path, "r") as fh:
+        for line in fh:
+            if line.strip():
+                records.append(json.loads(line))
+    return Dataset(path, records)
+
+
+def _is_parquet(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in (".parquet", ".pq")
+
+
+def iter_emails(path: str, chunk_size: int = STREAM_CHUNK_SIZE, shard: int = 0, num_shards: int = 1):
+    """
+    Yield the emails of a JSONL or Parquet file in lists of up to `chunk_size`, without reading
+    the whole file. With `num_shards` > 1 only every num_shards-th email (from `shard`) is kept.
+    """
+    chunk = []
+    for index, email in enumerate(_iter_records(path)):
+        if index % num_shards != shard:
+            continue
+        chunk.append(email)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_records(path: str):
+    if _is_parquet(path):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=STREAM_CHUNK_SIZE):
+            yield from batch.to_pylist()
+        return
+    with open(path, "r") as fh:
+        for line in fh:
+            if line.strip():
+                yield json.loads(line)
+
+
+def count_emails(path: str) -> int:
+    if _is_parquet(path):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    with open(path, "rb") as fh:
+        return sum(1 for line in fh if line.strip())
+
+
+def save_upload(name: str, fh) -> str:
+    """Copy an uploaded file-like object into UPLOAD_DIR; returns the stored path."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, partial = tempfile.mkstemp(dir=UPLOAD_DIR, prefix=".upload-")
+    with os.fdopen(fd, "wb") as out:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+            out.write(block)
+    stem, ext = os.path.splitext(os.path.basename(name))
+    path = os.path.join(UPLOAD_DIR, f"{stem}-{digest.hexdigest()[:12]}{ext.lower()}")
+    os.replace(partial, path)
+    return path
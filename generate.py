@@ -1,39 +1,321 @@
-from openai import OpenAI
 from dotenv import load_dotenv
+import asyncio
 import os
-import yaml
 import json
+import hashlib
+import logging
+import time
+from cache import cache_key, get_cache
+from metrics import get_metrics
+from clients import get_client, get_async_client
+from rate_limit import get_rate_controller
+from local_checks import JUDGE_POLICY, JUDGE_SAMPLE
+from singleflight import get_singleflight
+from prompt_templates import load_prompts, fingerprint
 
 load_dotenv()
 
-with open("prompts.yaml", "r") as f:
-    prompts = yaml.safe_load(f)
+logger = logging.getLogger(__name__)
+
+_prompts = None
+
+
+def get_prompts() -> dict:
+    """prompts.yaml, compiled on first use; a malformed file fails the first GenerateEmail() rather than an API call."""
+    global _prompts
+    if _prompts is None:
+        _prompts = load_prompts()
+    return _prompts
+
+# ask for faithfulness and completeness in one judge call instead of two
+FUSED_JUDGE = os.getenv("EMAIL_FUSED_JUDGE", "1").lower() not in ("0", "false", "no")
+
+# share one upstream call between identical requests that are in flight at the same time
+COALESCE = os.getenv("EMAIL_COALESCE", "1").lower() not in ("0", "false", "no")
+
+# batch runs ask for every tone of an email in one request instead of one request per tone
+TONE_FANOUT = os.getenv("EMAIL_TONE_FANOUT", "1").lower() not in ("0", "false", "no")
+
+_RATING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "rating": {"type": "integer", "enum": [1, 2, 3]},
+        "reasoning": {"type": "string"}
+    },
+    "required": ["rating", "reasoning"],
+    "additionalProperties": False
+}
+
+FUSED_JUDGE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "email_judgement",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "faithfulness": _RATING_SCHEMA,
+                "completeness": _RATING_SCHEMA
+            },
+            "required": ["faithfulness", "completeness"],
+            "additionalProperties": False
+        }
+    }
+}
+
+
+def tone_variants_format(tones) -> dict:
+    """Structured output with one string per requested tone."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "tone_variants",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {tone: {"type": "string"} for tone in tones},
+                "required": list(tones),
+                "additionalProperties": False
+            }
+        }
+    }
+
+
+def _parse_json(text):
+    try:
+        return json.loads(text)
+    except (TypeError, ValueError):
+        pass
+    # models sometimes wrap the JSON in prose or a code fence
+    if text and "{" in text and "}" in text:
+        try:
+            return json.loads(text[text.index("{"):text.rindex("}") + 1])
+        except ValueError:
+            pass
+    return None
+
+
+def parse_rating(model_rating) -> dict:
+    """Parse a judge response, falling back to a 0 rating instead of raising on malformed output."""
+    parsed = _parse_json(model_rating)
+    if isinstance(parsed, dict):
+        return parsed
+    return {"rating": 0, "reasoning": f"Could not parse judge response: {model_rating!r}"}
+
+
+def parse_variants(content, tones) -> dict:
+    """{tone: edited email} for each requested tone the response covers; malformed entries are left out."""
+    parsed = _parse_json(content)
+    if not isinstance(parsed, dict):
+        return {}
+    return {tone: parsed[tone] for tone in tones if isinstance(parsed.get(tone), str) and parsed[tone].strip()}
 
 class GenerateEmail():    
-    def __init__(self, model: str):
-        # initialize client once
-        self.client = OpenAI(
-            base_url=os.getenv("OPENAI_API_BASE"),
-            api_key=os.getenv("OPENAI_API_KEY"),
-        )
+    def __init__(self, model: str, use_cache: bool = True, fused_judge: bool = FUSED_JUDGE, run_id: str = None,
+                 judge_policy: str = JUDGE_POLICY, judge_sample: float = JUDGE_SAMPLE, coalesce: bool = COALESCE,
+                 tone_fanout: bool = TONE_FANOUT):
+        # clients are shared by the whole process (clients.py), so constructing this is cheap
+        self.client = get_client()
+        # chat calls are retried by the shared rate controller (rate_limit.py), not by the SDK,
+        # so every 429 reaches it and feeds its backoff
+        self._chat = get_client(max_retries=0).chat
+        self.rate = get_rate_controller()
+        self.prompts = get_prompts()
         self.deployment_name = model
         self.judge_model = "gpt-4.1"
+        # responses are deterministic (temperature=0), so identical requests are served from disk
+        self.cache = get_cache() if use_cache else None
+        # identical calls in flight at the same time, from any session, share one request
+        self.flight = get_singleflight() if coalesce else None
+        self.fused_judge = fused_judge
+        # batch runs generate all tone variants of an email in one request (generate_variants)
+        self.tone_fanout = tone_fanout
+        # which batch edits reach the LLM judge after the local checks (see local_checks.py)
+        self.judge_policy = judge_policy
+        self.judge_sample = judge_sample
+        # last fused judgement, so judge_faithfulness + judge_completeness on the same edit make one call
+        self._last_judgement = (None, None)
+        # every call is recorded here; run_id groups the calls of one Generate/Compare run
+        self.metrics = get_metrics()
+        self.run_id = run_id
+
+    def _cached(self, key, model, prompt_name):
+        if self.cache is None:
+            return None
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.metrics.record(model, prompt_name, cache_hit=True, run_id=self.run_id)
+        return cached
+
+    def _record_coalesced(self, model, prompt_name):
+        self.metrics.record(model, prompt_name, coalesced=True, run_id=self.run_id)
 
-    def _call_api(self, messages, is_judge=False):
+    def _record_error(self, model, prompt_name, start, exc):
+        self.metrics.record(model, prompt_name, latency=time.perf_counter() - start, error=type(exc).__name__,
+                            run_id=self.run_id)
+
+    def _call_api(self, messages, is_judge=False, prompt_name="custom", **params):
         selected_model = "gpt-4.1" if is_judge else self.deployment_name
-        response = self.client.chat.completions.create(
-            model=selected_model,
-            messages=messages,
-            temperature=0
-            # max_tokens=250 
-        )
+        params = {"temperature": 0, **params}
+        key = cache_key(selected_model, messages, **params)
+        cached = self._cached(key, selected_model, prompt_name)
+        if cached is not None:
+            return cached
+
+        def request():
+            return self._chat.completions.with_raw_response.create(
+                model=selected_model,
+                messages=messages,
+                **params
+                # max_tokens=250 
+            )
+
+        def call():
+            start = time.perf_counter()
+            try:
+                raw, retries = self.rate.call(selected_model, messages, params, request)
+            except Exception as exc:
+                self._record_error(selected_model, prompt_name, start, exc)
+                raise
+            response = raw.parse()
+            content = response.choices[0].message.content
+            self.rate.settle(selected_model, messages, params, response.usage)
+            self.metrics.record_usage(selected_model, prompt_name, time.perf_counter() - start, response.usage,
+                                      retries=retries, run_id=self.run_id)
+
+            logger.debug("%s response: %s", prompt_name, content)
+            if self.cache is not None:
+                self.cache.set(key, content)
+            return content
+
+        if self.flight is None:
+            return call()
+        content, shared = self.flight.do(key, call)
+        if shared:
+            self._record_coalesced(selected_model, prompt_name)
+        return content
+
+    def _stream_api(self, messages, is_judge=False, prompt_name="custom", **params):
+        """Yield the response text as it arrives; the full text is cached once the stream ends."""
+        selected_model = "gpt-4.1" if is_judge else self.deployment_name
+        params = {"temperature": 0, **params}
+        key = cache_key(selected_model, messages, **params)
+        cached = self._cached(key, selected_model, prompt_name)
+        if cached is not None:
+            yield cached
+            return
+
+        # an identical request already streaming in another session: wait for it and reuse its text
+        future, content = self.flight.join(key) if self.flight is not None else (None, None)
+        if self.flight is not None and future is None:
+            self._record_coalesced(selected_model, prompt_name)
+            yield content
+            return
+
+        def request():
+            return self._chat.completions.with_raw_response.create(
+                model=selected_model,
+                messages=messages,
+                stream=True,
+                # the last chunk then carries the usage block
+                stream_options={"include_usage": True},
+                **params
+            )
+
+        chunks = []
+        start = time.perf_counter()
+        try:
+            try:
+                # only opening the stream is budgeted and retried; a stream that fails midway is not replayed
+                raw, retries = self.rate.call(selected_model, messages, params, request)
+            except Exception as exc:
+                self._record_error(selected_model, prompt_name, start, exc)
+                raise
+            usage = None
+            for chunk in raw.parse():
+                usage = chunk.usage or usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+            content = "".join(chunks)
+            self.rate.settle(selected_model, messages, params, usage)
+            self.metrics.record_usage(selected_model, prompt_name, time.perf_counter() - start, usage,
+                                      retries=retries, run_id=self.run_id)
+
+            if self.cache is not None:
+                self.cache.set(key, content)
+        except BaseException as exc:
+            # every way out short of a cached result releases the key: a failed request or cache
+            # write is shared with the waiters, and a reader abandoning the stream hands them the call
+            if future is not None:
+                self.flight.end(key, future, exc=exc)
+            raise
+        if future is not None:
+            self.flight.end(key, future, content)
 
-        print(response.choices[0].message.content)
-        return response.choices[0].message.content
+    async def _acall_api(self, messages, is_judge=False, prompt_name="custom", **params):
+        selected_model = "gpt-4.1" if is_judge else self.deployment_name
+        params = {"temperature": 0, **params}
+        key = cache_key(selected_model, messages, **params)
+        cached = self._cached(key, selected_model, prompt_name)
+        if cached is not None:
+            return cached
+
+        def request():
+            return get_async_client(max_retries=0).chat.completions.with_raw_response.create(
+                model=selected_model,
+                messages=messages,
+                **params
+            )
+
+        async def call():
+            start = time.perf_counter()
+            try:
+                raw, retries = await self.rate.acall(selected_model, messages, params, request)
+            except Exception as exc:
+                self._record_error(selected_model, prompt_name, start, exc)
+                raise
+            response = raw.parse()
+            content = response.choices[0].message.content
+            self.rate.settle(selected_model, messages, params, response.usage)
+            self.metrics.record_usage(selected_model, prompt_name, time.perf_counter() - start, response.usage,
+                                      retries=retries, run_id=self.run_id)
+
+            if self.cache is not None:
+                self.cache.set(key, content)
+            return content
+
+        if self.flight is None:
+            return await call()
+        content, shared = await self.flight.ado(key, call)
+        if shared:
+            self._record_coalesced(selected_model, prompt_name)
+        return content
+    
+    def prompt_version(self, action: str) -> str:
+        """Fingerprint of the prompts and judge settings that shape results for `action`."""
+        judge_prompts = ["fused_judge"] if self.fused_judge else ["faithfulness_judge", "completeness_judge"]
+        # fanned-out tones come from their own prompt, with change_tone as the per-variant fallback
+        variant_prompts = ["change_tone_variants"] if action == "change_tone" and self.tone_fanout else []
+        payload = {
+            "prompts": fingerprint(self.prompts[name] for name in [action] + variant_prompts + judge_prompts),
+            "judge_format": FUSED_JUDGE_FORMAT if self.fused_judge else None,
+            "judge_policy": [self.judge_policy, self.judge_sample if self.judge_policy == "sample" else None]
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()[:16]
     
     def get_prompt(self, prompt_name, prompt_type='user', **kwargs):
-        template = prompts[prompt_name][prompt_type]
-        return template.format(**kwargs)
+        template = self.prompts[prompt_name]
+        # the system prompt is static so that it forms a cacheable prefix
+        if prompt_type == 'system':
+            return template.system
+        return template.render(**kwargs)
+
+    def _messages(self, prompt_name, **kwargs):
+        return self.prompts[prompt_name].messages(**kwargs)
     
     def send_prompt(self, user_prompt: str, system_msg="You are a helpful assistant."):
         messages = [
@@ -41,68 +323,147 @@ class GenerateEmail():
             {"role": "user", "content": user_prompt}
         ]
         return self._call_api(messages)
-    
-    def generate(self, action: str, text: str = None, **kwargs) -> str:
+
+    def _generate_messages(self, action: str, text: str = None, **kwargs):
         if not text:
             text = "Hello World!"
 
-        if action == "shorten":
-            args = {
-                "selected_text": text
-            }
-            system_prompt = self.get_prompt('shorten', prompt_type='system', **args)
-            user_prompt = self.get_prompt('shorten', **args)
-            print("system prompt:", system_prompt)
-            print("user prompt:", user_prompt)
-            model_response = self.send_prompt(user_prompt, system_prompt)
-            return model_response
-        
-        elif action == "lengthen":
+        if action in ("shorten", "lengthen"):
             args = {
                 "selected_text": text
             }
-            system_prompt = self.get_prompt('lengthen', prompt_type='system', **args)
-            user_prompt = self.get_prompt('lengthen', **args)
-            print("system prompt:", system_prompt)
-            print("user prompt:", user_prompt)
-            model_response = self.send_prompt(user_prompt, system_prompt)
-            return model_response
-        
         elif action == "change_tone":
-            tone = kwargs.get("tone", "friendly")
             args = {
                 "selected_text": text,
-                "tone": tone
+                "tone": kwargs.get("tone", "friendly")
             }
-            system_prompt = self.get_prompt('change_tone', prompt_type='system', **args)
-            user_prompt = self.get_prompt('change_tone', **args)
-            print("system prompt:", system_prompt)
-            print("user prompt:", user_prompt)
-            model_response = self.send_prompt(user_prompt, system_prompt)
-            return model_response
+        else:
+            return None
+        return self._messages(action, **args)
     
-    def judge_faithfulness(self, original_email: str, edited_email: str) -> dict:
+    def generate(self, action: str, text: str = None, stream: bool = False, **kwargs):
+        """Return the edited email, or an iterator of text chunks when `stream` is set."""
+        messages = self._generate_messages(action, text, **kwargs)
+        if messages is None:
+            return None
+        logger.debug("system prompt: %s", messages[0]["content"])
+        logger.debug("user prompt: %s", messages[1]["content"])
+        if stream:
+            return self._stream_api(messages, prompt_name=action)
+        return self._call_api(messages, prompt_name=action)
+
+    async def agenerate(self, action: str, text: str = None, **kwargs) -> str:
+        messages = self._generate_messages(action, text, **kwargs)
+        if messages is None:
+            return None
+        return await self._acall_api(messages, prompt_name=action)
+
+    def _variants_messages(self, text: str, tones):
+        return self._messages("change_tone_variants", selected_text=text or "Hello World!", tones=", ".join(tones))
+
+    def _missing_variants(self, content, tones):
+        variants = parse_variants(content, tones)
+        missing = [tone for tone in tones if tone not in variants]
+        if missing:
+            logger.warning("Tone variants response lacks %s; generating those tones one by one", ", ".join(missing))
+        return variants, missing
+
+    def generate_variants(self, text: str, tones) -> dict:
+        """
+        Every tone variant of `text` from one structured request, as {tone: edited email}. Tones
+        the response does not cover (e.g. malformed JSON) fall back to one change_tone call each.
+        """
+        tones = list(tones)
+        content = self._call_api(self._variants_messages(text, tones), prompt_name="change_tone_variants",
+                                 response_format=tone_variants_format(tones))
+        variants, missing = self._missing_variants(content, tones)
+        for tone in missing:
+            variants[tone] = self.generate("change_tone", text, tone=tone)
+        return variants
+
+    async def agenerate_variants(self, text: str, tones) -> dict:
+        tones = list(tones)
+        content = await self._acall_api(self._variants_messages(text, tones), prompt_name="change_tone_variants",
+                                        response_format=tone_variants_format(tones))
+        variants, missing = self._missing_variants(content, tones)
+        fallbacks = await asyncio.gather(*(self.agenerate("change_tone", text, tone=tone) for tone in missing))
+        variants.update(zip(missing, fallbacks))
+        return variants
+
+    def _faithfulness_messages(self, original_email: str, edited_email: str):
         args = {
             "selected_text": original_email,
             "model_response": edited_email
         }
+        return self._messages('faithfulness_judge', **args)
 
-        system_prompt = self.get_prompt('faithfulness_judge', prompt_type='system', **args)
-        user_prompt = self.get_prompt('faithfulness_judge', **args)
-        model_rating = self.send_prompt(user_prompt, system_prompt)
-        return json.loads(model_rating)
+    def _completeness_messages(self, instruction: str, original_email: str, edited_email: str):
+        args = {
+            "instruction": instruction,
+            "selected_text": original_email,
+            "model_response": edited_email
+        }
+        return self._messages('completeness_judge', **args)
     
-    def judge_completeness(self, instruction: str, original_email: str, edited_email: str) -> dict:
+    def _fused_judge_messages(self, instruction: str, original_email: str, edited_email: str):
         args = {
             "instruction": instruction,
             "selected_text": original_email,
             "model_response": edited_email
         }
+        return self._messages('fused_judge', **args)
 
-        system_prompt = self.get_prompt('completeness_judge', prompt_type='system', **args)
-        user_prompt = self.get_prompt('completeness_judge', **args)
-        model_rating = self.send_prompt(user_prompt, system_prompt)
-        return json.loads(model_rating)
+    def _split_judgement(self, model_rating) -> dict:
+        judgement = parse_rating(model_rating)
+        return {name: judgement[name] if isinstance(judgement.get(name), dict) else parse_rating(None)
+                for name in ("faithfulness", "completeness")}
+
+    def judge_both(self, instruction: str, original_email: str, edited_email: str) -> dict:
+        """Rate faithfulness and completeness in a single structured-output call."""
+        inputs = (instruction, original_email, edited_email)
+        if self._last_judgement[0] == inputs:
+            return self._last_judgement[1]
+        model_rating = self._call_api(self._fused_judge_messages(*inputs), prompt_name="fused_judge",
+                                     response_format=FUSED_JUDGE_FORMAT)
+        judgement = self._split_judgement(model_rating)
+        self._last_judgement = (inputs, judgement)
+        return judgement
+
+    async def ajudge_both(self, instruction: str, original_email: str, edited_email: str) -> dict:
+        model_rating = await self._acall_api(
+            self._fused_judge_messages(instruction, original_email, edited_email), prompt_name="fused_judge",
+            response_format=FUSED_JUDGE_FORMAT
+        )
+        return self._split_judgement(model_rating)
+    
+    def judge_faithfulness(self, original_email: str, edited_email: str, instruction: str = None) -> dict:
+        # the fused prompt needs the instruction, without it fall back to the standalone judge
+        if self.fused_judge and instruction is not None:
+            return self.judge_both(instruction, original_email, edited_email)["faithfulness"]
+        model_rating = self._call_api(self._faithfulness_messages(original_email, edited_email),
+                                     prompt_name="faithfulness_judge")
+        return parse_rating(model_rating)
+    
+    def judge_completeness(self, instruction: str, original_email: str, edited_email: str) -> dict:
+        if self.fused_judge:
+            return self.judge_both(instruction, original_email, edited_email)["completeness"]
+        model_rating = self._call_api(self._completeness_messages(instruction, original_email, edited_email),
+                                     prompt_name="completeness_judge")
+        return parse_rating(model_rating)
+
+    async def ajudge_faithfulness(self, original_email: str, edited_email: str, instruction: str = None) -> dict:
+        if self.fused_judge and instruction is not None:
+            return (await self.ajudge_both(instruction, original_email, edited_email))["faithfulness"]
+        model_rating = await self._acall_api(self._faithfulness_messages(original_email, edited_email),
+                                             prompt_name="faithfulness_judge")
+        return parse_rating(model_rating)
+
+    async def ajudge_completeness(self, instruction: str, original_email: str, edited_email: str) -> dict:
+        if self.fused_judge:
+            return (await self.ajudge_both(instruction, original_email, edited_email))["completeness"]
+        model_rating = await self._acall_api(self._completeness_messages(instruction, original_email, edited_email),
+                                             prompt_name="completeness_judge")
+        return parse_rating(model_rating)
 
 
 """
@@ -111,4 +472,4 @@ if __name__ == "__main__":
     res = gen.generate("lengthen")
     print("\nResult:")
     print(res)
-"""
\ No newline at end of file
+"""
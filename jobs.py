@@ -0,0 +1,234 @@
+"""
+Background jobs for Generate and Compare runs.
+
+A run inside the Streamlit script is aborted by the next rerun, so batches run here instead.
+A fixed pool of worker threads takes jobs from a queue, so at most MAX_JOBS run at once and
+the rest wait their turn. Each job reports progress, running averages and its records so far,
+which the tabs poll. Jobs belong to the process rather than a session, so they survive reruns
+and every session sees them.
+
+A cancelled or failed job can be resumed. The emails it finished are already in the results
+store (bundled datasets) or its results file (streamed datasets), so the resumed run only
+evaluates the rest.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from batch import run_stored_batch, DEFAULT_CONCURRENCY
+from dataset_store import dataset_path, read_dataset
+from pipeline import RunningAverages, run_streamed, results_path, summarize_results
+from results_store import get_results_store
+
+logger = logging.getLogger(__name__)
+
+# jobs running at the same time; the rest stay queued
+MAX_JOBS = int(os.getenv("EMAIL_MAX_JOBS", "3"))
+# finished jobs kept around for the jobs panel
+JOB_HISTORY = int(os.getenv("EMAIL_JOB_HISTORY", "50"))
+
+ACTIVE = ("queued", "running")
+
+
+class JobCancelled(Exception):
+    """Raised from a job's callbacks once it is cancelled, which stops the batch under it."""
+
+
+class Job():
+    def __init__(self, kind, label, target, params, keep_records=True):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.label = label
+        self.target = target
+        self.params = params
+        # streamed jobs write their records to `output` instead of holding them
+        self.keep_records = keep_records
+        self.output = None
+        self.created = time.time()
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.status = "queued"
+        self.done = 0
+        self.total = 0
+        self.phase = ""
+        self.records = []
+        self.recent = deque(maxlen=20)
+        self.averages = RunningAverages()
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    # --- called by the job target, on its worker thread ---
+    def _check(self):
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def progress(self, done, total, phase=None):
+        self._check()
+        with self._lock:
+            self.done, self.total = done, total
+            if phase is not None:
+                self.phase = phase
+
+    def add_records(self, records):
+        self._check()
+        with self._lock:
+            self.averages.update(records)
+            self.recent.extend(records)
+            if self.keep_records:
+                self.records.extend(records)
+
+    # --- called by the UI ---
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def active(self) -> bool:
+        return self.status in ACTIVE
+
+    def partial_records(self) -> list:
+        with self._lock:
+            return list(self.records)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            end = self.finished or time.time()
+            return {
+                "id": self.id,
+                "kind": self.kind,
+                "label": self.label,
+                "status": "cancelling" if self.active and self._cancel.is_set() else self.status,
+                "done": self.done,
+                "total": self.total,
+                "phase": self.phase,
+                "error": self.error,
+                "elapsed": end - self.started if self.started else 0.0,
+                "summary": self.averages.summary(),
+                "recent": list(self.recent),
+            }
+
+
+class JobRunner():
+    def __init__(self, max_jobs=MAX_JOBS, history=JOB_HISTORY):
+        self.history = history
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        for number in range(max(1, max_jobs)):
+            threading.Thread(target=self._work, name=f"email-job-{number}", daemon=True).start()
+
+    def submit(self, kind, label, target, keep_records=True, **params) -> Job:
+        """Queue `target(job, **params)`; its return value becomes `job.result`."""
+        job = Job(kind, label, target, params, keep_records=keep_records)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._queue.put(job)
+        return job
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+
+    def resume(self, job_id) -> Job:
+        """Queue a cancelled or failed job again under the same id."""
+        job = self.get(job_id)
+        if job is None or job.status not in ("cancelled", "failed"):
+            return job
+        with job._lock:
+            job._cancel.clear()
+            job._reset()
+        if "reuse" in job.params:
+            # what the first attempt finished is in the results store; only evaluate the rest
+            job.params["reuse"] = True
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id) -> Job:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> list:
+        """All known jobs, newest first."""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.created, reverse=True)
+
+    def _work(self):
+        while True:
+            self._run(self._queue.get())
+
+    def _run(self, job):
+        if job._cancel.is_set():
+            job.status, job.finished = "cancelled", time.time()
+            return
+        job.status, job.started = "running", time.time()
+        try:
+            job.result = job.target(job, **job.params)
+            job.status = "done"
+        except JobCancelled:
+            job.status = "cancelled"
+        except Exception as exc:
+            logger.exception("Job %s (%s) failed", job.id, job.label)
+            job.error = f"{type(exc).__name__}: {exc}"
+            job.status = "failed"
+        finally:
+            job.finished = time.time()
+            self._trim()
+
+    def _trim(self):
+        with self._lock:
+            finished = [job for job in self._jobs.values() if not job.active]
+            for job in sorted(finished, key=lambda job: job.created)[:max(0, len(finished) - self.history)]:
+                del self._jobs[job.id]
+
+
+_shared_runner = None
+_shared_lock = threading.Lock()
+
+
+def get_job_runner():
+    global _shared_runner
+    with _shared_lock:
+        if _shared_runner is None:
+            _shared_runner = JobRunner()
+        return _shared_runner
+
+
+# --- job targets ---
+def stored_job(job, dataset, action, models, concurrency=DEFAULT_CONCURRENCY, reuse=True, generator_options=None):
+    """Generate (one model) or Compare (several) over a bundled dataset, through the results store."""
+    # loaded by the first job rather than by the page that lists jobs
+    from generate import GenerateEmail
+    emails = read_dataset(dataset_path(dataset)).records
+    records = []
+    for position, model in enumerate(models):
+        def report(done, total, offset=position * len(emails)):
+            job.progress(offset + done, len(emails) * len(models), phase=model)
+
+        generator = GenerateEmail(model=model, run_id=job.id, **(generator_options or {}))
+        records += run_stored_batch(get_results_store(), dataset, emails, action, model, concurrency=concurrency,
+                                    on_progress=report, generator=generator, reuse=reuse,
+                                    on_result=lambda email, new_records: job.add_records(new_records))
+    return records
+
+
+def streamed_job(job, path, action, model, concurrency=DEFAULT_CONCURRENCY, generator_options=None):
+    """Generate over an uploaded or server-side dataset, streamed to a results file."""
+    from generate import GenerateEmail
+    generator = GenerateEmail(model=model, run_id=job.id, **(generator_options or {}))
+    job.output = results_path(path, model, generator.prompt_version(action))
+    try:
+        run_streamed(path, job.output, action, model, concurrency=concurrency, generator=generator,
+                     on_progress=lambda done, total, averages: job.progress(done, total, phase=model),
+                     on_result=lambda email, records: job.add_records(records))
+    finally:
+        # also set when cancelled or failed, so the records written so far can be browsed
+        job.result = {"path": job.output, "summary": summarize_results(job.output)}
+    return job.result
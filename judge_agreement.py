@@ -0,0 +1,63 @@
+"""
+Check that the fused judge agrees with the two-call judges on the bundled datasets.
+
+    python judge_agreement.py --model gpt-4o-mini --limit 20
+
+Edits are generated once (the second pass is served by the response cache), then judged
+in both modes. Reports exact agreement, agreement within one point and the mean rating
+of each mode per metric.
+"""
+import argparse
+import json
+from batch import run_batch, dataset_action
+from generate import GenerateEmail
+
+DATASETS = ["lengthen.jsonl", "shorten.jsonl", "tone.jsonl"]
+METRICS = ["faithfulness", "completeness"]
+
+
+def compare(two_call_results, fused_results) -> dict:
+    summary = {}
+    for metric in METRICS:
+        pairs = [
+            (a[metric].get("rating", 0), b[metric].get("rating", 0))
+            for a, b in zip(two_call_results, fused_results)
+        ]
+        n = len(pairs) or 1
+        summary[metric] = {
+            "exact": sum(a == b for a, b in pairs) / n,
+            "within_1": sum(abs(a - b) <= 1 for a, b in pairs) / n,
+            "mean_two_call": sum(a for a, _ in pairs) / n,
+            "mean_fused": sum(b for _, b in pairs) / n,
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--datasets", nargs="+", default=DATASETS)
+    parser.add_argument("--limit", type=int, default=None, help="only judge the first N emails of each dataset")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    for dataset in args.datasets:
+        with open("datasets/" + dataset, "r") as fh:
+            emails = [json.loads(line) for line in fh][:args.limit]
+        action = dataset_action(dataset)
+
+        two_call = run_batch(emails, action, args.model, concurrency=args.concurrency,
+                             generator=GenerateEmail(model=args.model, fused_judge=False, judge_policy="all"))
+        fused = run_batch(emails, action, args.model, concurrency=args.concurrency,
+                          generator=GenerateEmail(model=args.model, fused_judge=True, judge_policy="all"))
+
+        print(f"\n{dataset} ({len(two_call)} edits)")
+        for metric, stats in compare(two_call, fused).items():
+            print(
+                f"  {metric:<13} exact {stats['exact']:.0%}  within-1 {stats['within_1']:.0%}  "
+                f"mean two-call {stats['mean_two_call']:.2f}  mean fused {stats['mean_fused']:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
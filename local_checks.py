@@ -0,0 +1,132 @@
+"""
+Cheap deterministic checks over a batch of edits, run before any judge call.
+
+`local_metrics` computes length ratio, token overlap and greeting/closing preservation for a
+whole batch at once with pandas. The judge policy then decides which edits still go to the
+LLM judge:
+
+- "all" (default): judge every edit; local metrics are informational only.
+- "skip_failures": edits that fail a hard check (empty, unchanged, or a shorten that
+  got longer / a lengthen that got shorter) get completeness 1 without a judge call, which is
+  what the completeness rubric prescribes for them.
+- "sample": like "skip_failures", and only a deterministic `sample` fraction of the remaining
+  edits is judged. The rest keep a None rating, which averages skip.
+"""
+import os
+
+POLICIES = ("all", "skip_failures", "sample")
+JUDGE_POLICY = os.getenv("EMAIL_JUDGE_POLICY", "all")
+JUDGE_SAMPLE = float(os.getenv("EMAIL_JUDGE_SAMPLE", "0.25"))
+
+# word-count ratio the shorten/lengthen prompts ask for
+LENGTH_TARGETS = {"shorten": (0.5, 0.75), "lengthen": (1.5, 2.0)}
+
+_GREETING = r"(?i)^\s*(?:hi|hello|hey|dear|greetings|good (?:morning|afternoon|evening))\b"
+_CLOSING = (r"(?i)\b(?:best|regards|sincerely|cheers|thanks|thank you|warmly|talk soon|all the best)\b"
+            r"[^.!?\n]{0,40}[,.!]?\s*$")
+_WORD = r"\w+"
+
+
+def _action(user_instruction: str) -> str:
+    return "change_tone" if user_instruction.startswith("change_tone") else user_instruction
+
+
+def _token_overlap(original, edited):
+    """Jaccard overlap of the lower-cased word sets of each pair, computed in long format."""
+    def tokens(texts):
+        frame = texts.str.lower().str.findall(_WORD).explode().dropna().rename("token").reset_index()
+        return frame.drop_duplicates()
+
+    original_tokens, edited_tokens = tokens(original), tokens(edited)
+    shared = original_tokens.merge(edited_tokens, on=["index", "token"]).groupby("index").size()
+    original_count = original_tokens.groupby("index").size()
+    edited_count = edited_tokens.groupby("index").size()
+    union = original_count.add(edited_count, fill_value=0).sub(shared, fill_value=0)
+    return shared.div(union).reindex(original.index).fillna(0.0)
+
+
+def local_metrics(originals, edits, user_instructions) -> "pandas.DataFrame":
+    """One row of local metrics per (original, edit) pair, in input order."""
+    # imported on first use, so importing this module (e.g. for the policy settings) stays cheap
+    import pandas
+    original = pandas.Series(list(originals), dtype=object).fillna("").astype(str)
+    edited = pandas.Series(list(edits), dtype=object).fillna("").astype(str)
+    action = pandas.Series(list(user_instructions), dtype=object).map(_action)
+
+    original_words = original.str.count(_WORD)
+    edited_words = edited.str.count(_WORD)
+    length_ratio = edited_words / original_words.clip(lower=1)
+
+    low = action.map(lambda name: LENGTH_TARGETS.get(name, (None, None))[0]).astype(float)
+    high = action.map(lambda name: LENGTH_TARGETS.get(name, (None, None))[1]).astype(float)
+    has_target = low.notna()
+    on_target = ~has_target | length_ratio.between(low.fillna(0), high.fillna(0))
+
+    empty = edited.str.strip() == ""
+    unchanged = edited.str.split().str.join(" ") == original.str.split().str.join(" ")
+    wrong_direction = ((action == "shorten") & (length_ratio >= 1)) | ((action == "lengthen") & (length_ratio <= 1))
+
+    metrics = pandas.DataFrame({
+        "length_ratio": length_ratio.round(3),
+        "on_target": on_target,
+        "token_overlap": _token_overlap(original, edited).round(3),
+        "greeting_kept": original.str.contains(_GREETING) == edited.str.contains(_GREETING),
+        "closing_kept": original.str.contains(_CLOSING) == edited.str.contains(_CLOSING),
+        "empty": empty,
+        "unchanged": unchanged & ~empty,
+    })
+    metrics["failure"] = None
+    metrics.loc[wrong_direction & ~empty, "failure"] = "wrong_length"
+    metrics.loc[metrics["unchanged"], "failure"] = "unchanged"
+    metrics.loc[empty, "failure"] = "empty"
+    return metrics
+
+
+def _sampled(record_ids, fraction):
+    # stable per record id, so re-runs judge the same sample
+    import pandas
+    hashes = pandas.util.hash_pandas_object(pandas.Series([str(i) for i in record_ids], dtype=object), index=False)
+    return (hashes.to_numpy() / 2.0 ** 64) < fraction
+
+
+_FAILURE_REASONS = {
+    "empty": "The edited email is empty.",
+    "unchanged": "The edited email is identical to the original, so the instruction was not applied.",
+    "wrong_length": "The edited email moved in the wrong direction for the requested length change.",
+}
+
+
+def apply_checks(records, policy=JUDGE_POLICY, sample=JUDGE_SAMPLE) -> list:
+    """
+    Attach `local_checks` to every record and settle the ones the policy does not send to the
+    judge. Returns the records that still need an LLM judgement.
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown judge policy {policy!r}, expected one of {', '.join(POLICIES)}")
+    if not records:
+        return []
+    metrics = local_metrics(
+        (record["original_email"] for record in records),
+        (record["edited_email"] for record in records),
+        (record["user_instruction"] for record in records),
+    )
+    sampled = _sampled([record["id"] for record in records], sample) if policy == "sample" else None
+
+    to_judge = []
+    for position, (record, checks) in enumerate(zip(records, metrics.to_dict("records"))):
+        record["local_checks"] = checks
+        failure = checks["failure"]
+        if policy != "all" and failure is not None:
+            reasoning = "Local check: " + _FAILURE_REASONS[failure]
+            record["faithfulness"] = (
+                {"rating": 3, "reasoning": "Local check: the edit repeats the original, so every detail is rooted in it."}
+                if failure == "unchanged" else {"rating": None, "reasoning": "Not judged. " + reasoning}
+            )
+            record["completeness"] = {"rating": 1, "reasoning": reasoning}
+        elif sampled is not None and not sampled[position]:
+            not_judged = {"rating": None, "reasoning": f"Not judged: outside the {sample:.0%} judge sample."}
+            record["faithfulness"], record["completeness"] = dict(not_judged), dict(not_judged)
+        else:
+            to_judge.append(record)
+    return to_judge
+
@@ -0,0 +1,186 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# every API call (and cache hit) is appended here as one JSON line when set
+METRICS_LOG = os.getenv("EMAIL_METRICS_LOG")
+# serve Prometheus text-format metrics on this port when set
+METRICS_PORT = os.getenv("EMAIL_METRICS_PORT")
+
+# per-call history kept for run summaries; the Prometheus counters are cumulative regardless
+METRICS_HISTORY = int(os.getenv("EMAIL_METRICS_HISTORY", "100000"))
+
+_COUNTERS = (
+    "email_api_calls_total", "email_api_cache_hits_total", "email_api_coalesced_total", "email_api_errors_total",
+    "email_api_retries_total", "email_api_latency_seconds_sum", "email_api_prompt_tokens_total",
+    "email_api_cached_tokens_total", "email_api_completion_tokens_total", "email_api_cost_usd_total"
+)
+
+# USD per 1M tokens: (input, cached input, output)
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+}
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0) -> float:
+    input_price, cached_price, output_price = PRICES.get(model, (0.0, 0.0, 0.0))
+    return (
+        (prompt_tokens - cached_tokens) * input_price
+        + cached_tokens * cached_price
+        + completion_tokens * output_price
+    ) / 1_000_000
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class Metrics():
+    """Process-wide record of every API call: latency, tokens, cache hits, retries and estimated cost."""
+
+    def __init__(self, log_path=METRICS_LOG, history=METRICS_HISTORY):
+        self.log_path = log_path
+        self.calls = deque(maxlen=history)
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def record(self, model, prompt_name, latency=0.0, prompt_tokens=0, completion_tokens=0, cached_tokens=0,
+               cache_hit=False, retries=0, error=None, run_id=None, coalesced=False):
+        call = {
+            "time": time.time(),
+            "run_id": run_id,
+            "model": model,
+            "prompt": prompt_name,
+            "latency": latency,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "cache_hit": cache_hit,
+            # answered by an identical request that was already in flight
+            "coalesced": coalesced,
+            "retries": retries,
+            "error": error,
+            "cost": 0.0 if cache_hit or coalesced else estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens)
+        }
+        with self._lock:
+            self.calls.append(call)
+            self._count(call)
+            if self.log_path:
+                with open(self.log_path, "a") as fh:
+                    fh.write(json.dumps(call) + "\n")
+        return call
+
+    def record_usage(self, model, prompt_name, latency, usage, retries=0, run_id=None):
+        """Record a completed call from the `usage` block of a chat completion (may be None)."""
+        details = getattr(usage, "prompt_tokens_details", None)
+        return self.record(
+            model, prompt_name, latency=latency,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+            cached_tokens=getattr(details, "cached_tokens", 0) or 0,
+            retries=retries, run_id=run_id
+        )
+
+    def _select(self, run_id=None):
+        with self._lock:
+            return [call for call in self.calls if run_id is None or call["run_id"] == run_id]
+
+    def summary(self, run_id=None) -> dict:
+        calls = self._select(run_id)
+        api_calls = [call for call in calls if not call["cache_hit"] and not call["coalesced"]]
+        latencies = [call["latency"] for call in api_calls if call["error"] is None]
+        by_prompt = {}
+        for call in calls:
+            entry = by_prompt.setdefault(call["prompt"], {"calls": 0, "cache_hits": 0, "coalesced": 0, "latency": 0.0,
+                                                          "tokens": 0, "cached_tokens": 0, "cost": 0.0})
+            entry["calls"] += 1
+            entry["cache_hits"] += call["cache_hit"]
+            entry["coalesced"] += call["coalesced"]
+            entry["latency"] += call["latency"]
+            entry["tokens"] += call["prompt_tokens"] + call["completion_tokens"]
+            entry["cached_tokens"] += call["cached_tokens"]
+            entry["cost"] += call["cost"]
+        prompt_tokens = sum(call["prompt_tokens"] for call in api_calls)
+        cached_tokens = sum(call["cached_tokens"] for call in api_calls)
+        return {
+            "calls": len(calls),
+            "api_calls": len(api_calls),
+            "cache_hits": sum(call["cache_hit"] for call in calls),
+            "coalesced": sum(call["coalesced"] for call in calls),
+            "errors": sum(call["error"] is not None for call in calls),
+            "retries": sum(call["retries"] for call in calls),
+            "p50_latency": _percentile(latencies, 50),
+            "p95_latency": _percentile(latencies, 95),
+            "p99_latency": _percentile(latencies, 99),
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            # share of input tokens the provider served from its prompt cache
+            "prefix_cache_rate": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+            "completion_tokens": sum(call["completion_tokens"] for call in api_calls),
+            "cost": sum(call["cost"] for call in calls),
+            "by_prompt": by_prompt
+        }
+
+    def _count(self, call):
+        labels = f'model="{call["model"]}",prompt="{call["prompt"]}"'
+        entry = self.totals.setdefault(labels, dict.fromkeys(_COUNTERS, 0))
+        entry["email_api_calls_total"] += 1
+        entry["email_api_cache_hits_total"] += call["cache_hit"]
+        entry["email_api_coalesced_total"] += call["coalesced"]
+        entry["email_api_errors_total"] += call["error"] is not None
+        entry["email_api_retries_total"] += call["retries"]
+        entry["email_api_latency_seconds_sum"] += call["latency"]
+        entry["email_api_prompt_tokens_total"] += call["prompt_tokens"]
+        entry["email_api_cached_tokens_total"] += call["cached_tokens"]
+        entry["email_api_completion_tokens_total"] += call["completion_tokens"]
+        entry["email_api_cost_usd_total"] += call["cost"]
+
+    def prometheus(self) -> str:
+        """Cumulative counters in Prometheus text exposition format, labelled by model and prompt."""
+        with self._lock:
+            totals = {labels: dict(values) for labels, values in self.totals.items()}
+        lines = []
+        for name in _COUNTERS:
+            lines.append(f"# TYPE {name} counter")
+            lines += [f"{name}{{{labels}}} {values[name]}" for labels, values in totals.items()]
+        return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(metrics, port: int):
+    """Expose `metrics.prometheus()` at http://0.0.0.0:<port>/metrics from a daemon thread."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            data = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+_shared_metrics = None
+_shared_lock = threading.Lock()
+
+
+def get_metrics():
+    global _shared_metrics
+    with _shared_lock:
+        if _shared_metrics is None:
+            _shared_metrics = Metrics()
+            if METRICS_PORT:
+                serve_prometheus(_shared_metrics, int(METRICS_PORT))
+        return _shared_metrics
@@ -0,0 +1,359 @@
+"""
+Local OpenAI-compatible stub for benchmarks and offline testing.
+
+    python mock_openai.py --port 8000 --latency 0.3 --jitter 0.1 --error-rate 0.01 --rate-limit-rate 0.02
+    OPENAI_API_BASE=http://127.0.0.1:8000/v1 OPENAI_API_KEY=mock streamlit run app.py
+
+Implements chat completions (plain and streamed) plus the files and batches endpoints used by
+batch_api.py. Edits are cheap deterministic rewrites of the email, and judge calls return a
+valid rating JSON, so the whole generate -> judge pipeline runs without spending real money.
+Prompt caching is imitated too: once a system prompt of at least `prefix_cache_min` tokens has
+been seen, later requests report it in `usage.prompt_tokens_details.cached_tokens`, rounded
+down to 128-token blocks like the real API. Every response carries x-ratelimit-* headers;
+with `rpm` set, the server also enforces that requests-per-minute quota over a sliding window.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# quotas reported when no --rpm is enforced, so clients learn a real limit from the headers
+NOMINAL_RPM = 30_000
+NOMINAL_TPM = 150_000_000
+
+
+class _Server(ThreadingHTTPServer):
+    # the default listen backlog of 5 makes high-concurrency runs stall on SYN retries
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def _words(text):
+    return re.findall(r"\S+", text or "")
+
+
+def _count_tokens(messages):
+    # rough stand-in for a tokenizer, about 0.75 words per token
+    return int(sum(len(_words(message.get("content"))) for message in messages) / 0.75) + 1
+
+
+def _email_text(messages):
+    # the email is the last paragraph of the user prompt in every bundled template
+    return messages[-1]["content"].rstrip().split("\n\n")[-1]
+
+
+def _message_tokens(message):
+    return int(len(_words(message.get("content"))) / 0.75)
+
+
+def fake_reply(body):
+    messages = body["messages"]
+    system = messages[0]["content"].lower()
+    schema = (body.get("response_format") or {}).get("json_schema") or {}
+    if schema.get("name") == "tone_variants":
+        text = " ".join(_words(_email_text(messages)))
+        return json.dumps({tone: text for tone in schema["schema"]["required"]})
+    if "judge" in system:
+        rating = {"rating": 3, "reasoning": "All details are rooted in the original email."}
+        if body.get("response_format"):
+            return json.dumps({"faithfulness": rating, "completeness": rating})
+        return json.dumps(rating)
+
+    words = _words(_email_text(messages))
+    if "shorten" in system:
+        words = words[:max(1, int(len(words) * 0.6))]
+    elif "lengthen" in system:
+        words = words + words[:max(1, len(words) // 2)]
+    return " ".join(words)
+
+
+class MockOpenAIServer():
+    """Threaded stub server; `latency` and `jitter` are seconds, the rates are per-request probabilities."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 seed=None, prefix_cache_min=1024, rpm=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.random = random.Random(seed)
+        self.prefix_cache_min = prefix_cache_min
+        self.rpm = rpm
+        self._window = deque()
+        self._prefixes = set()
+        self.files = {}
+        self.batches = {}
+        self.stats = {"chat": 0, "errors": 0, "rate_limited": 0, "batches": 0}
+        self._lock = threading.Lock()
+        self._httpd = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {name: 0 for name in self.stats}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _roll(self):
+        with self._lock:
+            return self.random.random(), max(0.0, self.random.gauss(self.latency, self.jitter))
+
+    def _quota(self):
+        """
+        (allowed, headers) for one request against the requests-per-minute quota. Like the real
+        API, every response reports its quotas; without --rpm they are generous and not enforced.
+        """
+        tokens = {"x-ratelimit-limit-tokens": str(NOMINAL_TPM), "x-ratelimit-remaining-tokens": str(NOMINAL_TPM)}
+        if not self.rpm:
+            return True, {"x-ratelimit-limit-requests": str(NOMINAL_RPM),
+                          "x-ratelimit-remaining-requests": str(NOMINAL_RPM), **tokens}
+        now = time.monotonic()
+        with self._lock:
+            while self._window and now - self._window[0] >= 60:
+                self._window.popleft()
+            allowed = len(self._window) < self.rpm
+            if allowed:
+                self._window.append(now)
+            reset_ms = int((60 - (now - self._window[0])) * 1000) if self._window else 0
+            remaining = self.rpm - len(self._window)
+        headers = {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset_ms}ms",
+            **tokens
+        }
+        if not allowed:
+            headers["retry-after-ms"] = str(reset_ms)
+        return allowed, headers
+
+    def _cached_tokens(self, messages):
+        if messages[0].get("role") != "system":
+            return 0
+        tokens = _message_tokens(messages[0])
+        if tokens < self.prefix_cache_min:
+            return 0
+        prefix = hashlib.sha256((messages[0].get("content") or "").encode("utf-8")).hexdigest()
+        with self._lock:
+            seen = prefix in self._prefixes
+            self._prefixes.add(prefix)
+        return tokens // 128 * 128 if seen else 0
+
+    def completion(self, body):
+        content = fake_reply(body)
+        prompt_tokens = _count_tokens(body["messages"])
+        completion_tokens = int(len(_words(content)) / 0.75) + 1
+        cached_tokens = self._cached_tokens(body["messages"])
+        return {
+            "id": "chatcmpl-" + uuid.uuid4().hex[:12],
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}
+            }
+        }
+
+    def run_batch(self, input_file_id, endpoint):
+        # like the real endpoint, failed requests (error_rate) go to the error file, not the output file
+        lines, errors = [], []
+        for line in self.files[input_file_id].decode("utf-8").splitlines():
+            request = json.loads(line)
+            if self._roll()[0] < self.error_rate:
+                errors.append(json.dumps({
+                    "id": "batch_req_" + uuid.uuid4().hex[:12],
+                    "custom_id": request["custom_id"],
+                    "response": None,
+                    "error": {"code": "server_error", "message": "Internal server error (mock)"}
+                }))
+                continue
+            lines.append(json.dumps({
+                "id": "batch_req_" + uuid.uuid4().hex[:12],
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": self.completion(request["body"])},
+                "error": None
+            }))
+        output_file_id = "file-" + uuid.uuid4().hex[:12]
+        self.files[output_file_id] = ("\n".join(lines) + "\n").encode("utf-8")
+        error_file_id = None
+        if errors:
+            error_file_id = "file-" + uuid.uuid4().hex[:12]
+            self.files[error_file_id] = ("\n".join(errors) + "\n").encode("utf-8")
+        batch_id = "batch_" + uuid.uuid4().hex[:12]
+        # batches finish instantly; a real provider would report in_progress for a while
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "completion_window": "24h",
+            "status": "completed",
+            "output_file_id": output_file_id,
+            "error_file_id": error_file_id,
+            "created_at": int(time.time()),
+            "request_counts": {"total": len(lines) + len(errors), "completed": len(lines), "failed": len(errors)}
+        }
+        self._count("batches")
+        return self.batches[batch_id]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body go out as separate writes; with Nagle on, each response waits on a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, payload, status=200, headers=None):
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _error(self, status, message, headers=None):
+                self._send_json({"error": {"message": message, "type": "mock_error", "code": None}}, status, headers)
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in server.batches:
+                    return self._send_json(server.batches[parts[2]])
+                if parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[2] in server.files:
+                    return self._send_json(server.files[parts[2]])
+                self._error(404, f"Unknown path {self.path}")
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path == "/v1/files":
+                    return self._upload(raw)
+                body = json.loads(raw or b"{}")
+                if self.path == "/v1/batches":
+                    return self._send_json(server.run_batch(body["input_file_id"], body["endpoint"]))
+                if self.path == "/v1/chat/completions":
+                    return self._chat(body)
+                self._error(404, f"Unknown path {self.path}")
+
+            def _upload(self, raw):
+                message = BytesParser(policy=default_policy).parsebytes(
+                    b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + raw
+                )
+                content = next(part.get_payload(decode=True) for part in message.iter_parts() if part.get_filename())
+                file_id = "file-" + uuid.uuid4().hex[:12]
+                server.files[file_id] = content
+                self._send_json({
+                    "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                    "filename": "batch.jsonl", "purpose": "batch", "status": "processed"
+                })
+
+            def _chat(self, body):
+                roll, delay = server._roll()
+                time.sleep(delay)
+                allowed, quota_headers = server._quota()
+                if not allowed:
+                    server._count("rate_limited")
+                    return self._error(429, "Requests per minute quota exceeded (mock)", quota_headers)
+                if roll < server.rate_limit_rate:
+                    server._count("rate_limited")
+                    return self._error(429, "Rate limit reached (mock)", {
+                        "retry-after-ms": "200", "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "200ms"
+                    })
+                if roll < server.rate_limit_rate + server.error_rate:
+                    server._count("errors")
+                    return self._error(500, "Internal server error (mock)")
+                server._count("chat")
+
+                completion = server.completion(body)
+                if not body.get("stream"):
+                    return self._send_json(completion, headers=quota_headers)
+
+                # server-sent events, one chunk per word, then [DONE]
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                for name, value in quota_headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                content = completion["choices"][0]["message"]["content"]
+                for word in re.findall(r"\S+\s*", content):
+                    chunk = {
+                        "id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+                        "model": body["model"],
+                        "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    chunk = {
+                        "id": completion["id"], "object": "chat.completion.chunk", "created": completion["created"],
+                        "model": body["model"], "choices": [], "usage": completion["usage"]
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.3, help="mean seconds per chat completion")
+    parser.add_argument("--jitter", type=float, default=0.1, help="standard deviation of the latency, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with a 500 (or failed, for batch requests)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls answered with a 429")
+    parser.add_argument("--prefix-cache-min", type=int, default=1024,
+                        help="smallest system prompt, in tokens, reported back as cached")
+    parser.add_argument("--rpm", type=int, help="enforce a requests-per-minute quota, answering 429 past it")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(args.host, args.port, args.latency, args.jitter, args.error_rate, args.rate_limit_rate,
+                              prefix_cache_min=args.prefix_cache_min, rpm=args.rpm)
+    print(f"Mock OpenAI API listening on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
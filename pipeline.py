@@ -0,0 +1,236 @@
+"""
+Bounded-memory evaluation of large JSONL/Parquet corpora.
+
+Emails are read in fixed-size chunks (dataset_store.iter_emails), each chunk goes through the
+batch engine, and its records are appended to a JSONL results file as soon as each email
+finishes. Only running totals stay in memory, so a 100k-email corpus needs no more memory than
+a single chunk. Results already in the output file are skipped, so a stopped run resumes.
+"""
+import hashlib
+import json
+import os
+from batch import run_batch, pending_emails, DEFAULT_CONCURRENCY
+from dataset_store import dataset_version, iter_emails, count_emails, STREAM_CHUNK_SIZE
+
+RESULTS_DIR = "results"
+
+_METRICS = ("faithfulness", "completeness")
+_CHECKS = ("length_ratio", "on_target", "token_overlap")
+
+
+class RunningAverages():
+    """Online means of the judge ratings (None ratings skipped) and the local checks."""
+
+    def __init__(self):
+        self.records = 0
+        self.flagged = 0
+        self.sums = dict.fromkeys(_METRICS + _CHECKS, 0.0)
+        self.counts = dict.fromkeys(_METRICS + _CHECKS, 0)
+
+    def _add(self, name, value):
+        if isinstance(value, (bool, int, float)):
+            self.sums[name] += value
+            self.counts[name] += 1
+
+    def update(self, records):
+        for record in records:
+            self.records += 1
+            for metric in _METRICS:
+                self._add(metric, (record.get(metric) or {}).get("rating"))
+            checks = record.get("local_checks") or {}
+            for name in _CHECKS:
+                self._add(name, checks.get(name))
+            self.flagged += checks.get("failure") is not None
+
+    def mean(self, name) -> float:
+        return self.sums[name] / self.counts[name] if self.counts[name] else 0.0
+
+    def summary(self) -> dict:
+        return {
+            "records": self.records,
+            "judged": self.counts["completeness"],
+            "flagged": self.flagged,
+            **{name: self.mean(name) for name in _METRICS + _CHECKS}
+        }
+
+
+def results_path(dataset_path: str, model: str, prompt_version: str) -> str:
+    """
+    Results file for one dataset file, model and prompt version. The name also hashes the
+    dataset's absolute path and version, so same-named files in different folders, or a file
+    edited in place, never resume each other's results.
+    """
+    stem = os.path.splitext(os.path.basename(dataset_path))[0]
+    source = json.dumps([os.path.realpath(dataset_path), dataset_version(dataset_path)])
+    digest = hashlib.sha256(source.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(RESULTS_DIR, f"{stem}-{digest}-{model}-{prompt_version}.jsonl")
+
+
+def drop_torn_line(path: str):
+    """Cut a half-written last line left by a killed run, so new records start on a fresh line."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as fh:
+        fh.seek(0, os.SEEK_END)
+        size = fh.tell()
+        if not size:
+            return
+        # scan back from the end in blocks instead of reading a possibly huge file
+        position = size
+        while position > 0:
+            step = min(1 << 16, position)
+            fh.seek(position - step)
+            block = fh.read(step)
+            if position == size and block.endswith(b"\n"):
+                return
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                fh.truncate(position - step + newline + 1)
+                return
+            position -= step
+        fh.truncate(0)
+
+
+def iter_results(path: str):
+    """Records of a results file, skipping a torn last line."""
+    if not os.path.exists(path):
+        return
+    with open(path, "r") as fh:
+        for line in fh:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def result_ids(*paths) -> set:
+    """Record ids already written to any of `paths`, e.g. an output and its shard files."""
+    return {str(record.get("id")) for path in paths for record in iter_results(path)}
+
+
+def summarize_results(path: str) -> dict:
+    """RunningAverages summary of a whole results file, read one record at a time."""
+    averages = RunningAverages()
+    averages.update(iter_results(path))
+    return averages.summary()
+
+
+def run_streamed(dataset, output, action, model, concurrency=DEFAULT_CONCURRENCY, generator=None,
+                 chunk_size=STREAM_CHUNK_SIZE, on_progress=None, shard=0, num_shards=1, done_ids=None, on_result=None):
+    """
+    Evaluate every email of `dataset` chunk by chunk, appending records to `output` as they finish.
+
+    `on_progress(done, total, averages)` is called after every email with the RunningAverages
+    over this run's new records, and `on_result(email, records)` once an email's records are
+    written. Emails whose records are all in `done_ids` (default: the ids already in `output`)
+    are skipped. Returns the RunningAverages.
+    """
+    done_ids = result_ids(output) if done_ids is None else done_ids
+    total = count_emails(dataset)
+    if num_shards > 1:
+        total = len(range(shard, total, num_shards))
+    averages = RunningAverages()
+    processed = 0
+
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    drop_torn_line(output)
+    with open(output, "a") as out:
+        def write_records(email, records):
+            for record in records:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            averages.update(records)
+            if on_result:
+                on_result(email, records)
+
+        for chunk in iter_emails(dataset, chunk_size, shard, num_shards):
+            pending = pending_emails(chunk, action, done_ids)
+            skipped = len(chunk) - len(pending)
+
+            def report(done, _, base=processed + skipped):
+                if on_progress:
+                    on_progress(base + done, total, averages)
+
+            if pending:
+                run_batch(pending, action, model, concurrency=concurrency, on_progress=report, generator=generator,
+                          on_result=write_records)
+                os.fsync(out.fileno())
+            processed += len(chunk)
+            if on_progress and skipped == len(chunk):
+                on_progress(processed, total, averages)
+    return averages
+
+
+def flatten_results(records) -> "pandas.DataFrame":
+    """One row per record; nested dicts become dotted columns such as faithfulness.rating."""
+    # pandas is only needed to browse results, not to run them
+    import pandas
+    frame = pandas.json_normalize(records) if records else pandas.DataFrame()
+    for column in ("faithfulness.rating", "completeness.rating"):
+        if column in frame:
+            # nullable ints, so ratings left as None by the judge policy do not turn 3 into 3.0
+            frame[column] = frame[column].astype("Int64")
+    return frame
+
+
+def record_from_row(row) -> dict:
+    """Rebuild a nested record from a flattened row, dropping missing values."""
+    import pandas
+    record = {}
+    for column, value in row.items():
+        if pandas.api.types.is_scalar(value) and pandas.isna(value):
+            continue
+        *parents, leaf = column.split(".")
+        target = record
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[leaf] = value
+    return record
+
+
+def filter_results(frame: "pandas.DataFrame", faithfulness=None, completeness=None, flagged_only=False,
+                   search="") -> "pandas.DataFrame":
+    """Rows matching the results-table filters; ratings are compared as text so "None" is selectable."""
+    import pandas
+    mask = pandas.Series(True, index=frame.index)
+    for column, wanted in (("faithfulness.rating", faithfulness), ("completeness.rating", completeness)):
+        if wanted and column in frame:
+            mask &= frame[column].map(lambda value: "None" if pandas.isna(value) else str(int(value))).isin(wanted)
+    if flagged_only:
+        mask &= frame["local_checks.failure"].notna() if "local_checks.failure" in frame else False
+    if search:
+        text = frame["id"].astype(str)
+        for column in ("original_email", "edited_email"):
+            if column in frame:
+                text = text + " " + frame[column].fillna("").astype(str)
+        mask &= text.str.contains(search, case=False, regex=False)
+    return frame[mask]
+
+
+def results_page(path: str, page: int, page_size: int, **filters):
+    """
+    (DataFrame of the matching records on `page`, number of matching records), reading the
+    results file in chunks so only one page is ever held in memory.
+    """
+    import pandas
+    rows, matches, first = [], 0, page * page_size
+    batch = []
+
+    def flush(batch):
+        nonlocal matches
+        frame = filter_results(flatten_results(batch), **filters)
+        start = max(0, first - matches)
+        end = max(0, first + page_size - matches)
+        if start < len(frame) and end > 0:
+            rows.append(frame.iloc[start:end])
+        matches += len(frame)
+
+    for record in iter_results(path):
+        batch.append(record)
+        if len(batch) >= 5000:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return (pandas.concat(rows, ignore_index=True) if rows else pandas.DataFrame()), matches
@@ -0,0 +1,71 @@
+"""
+Prompts from prompts.yaml, parsed and validated once (on first use) instead of on every call.
+
+Each prompt is a static `system` prefix plus a `user` template that carries the per-email
+content. Keeping the system message free of placeholders means every request for a prompt
+starts with the same bytes, which is what provider-side prompt caching keys on.
+"""
+import hashlib
+import json
+import os
+import re
+from string import Formatter
+
+PROMPTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts.yaml")
+
+# a leftover {name} in a system prompt; literal JSON examples such as {"rating": ...} are fine
+_PLACEHOLDER = re.compile(r"\{[A-Za-z_]\w*\}")
+
+
+class PromptTemplate():
+    """A static system prompt and a user template split into literal text and field names."""
+
+    def __init__(self, name: str, system: str, user: str):
+        self.name = name
+        self.system = system
+        self.user = user
+        self._parts = []
+        self.fields = set()
+        for literal, field, spec, conversion in Formatter().parse(user):
+            if spec or conversion or (field is not None and not field.isidentifier()):
+                raise ValueError(f"Prompt {name!r}: only plain {{name}} fields are supported in the user template")
+            if literal:
+                self._parts.append((literal, None))
+            if field is not None:
+                self._parts.append((None, field))
+                self.fields.add(field)
+
+    def render(self, **kwargs) -> str:
+        missing = self.fields - kwargs.keys()
+        if missing:
+            raise KeyError(f"Prompt {self.name!r} is missing {', '.join(sorted(missing))}")
+        return "".join(literal if field is None else str(kwargs[field]) for literal, field in self._parts)
+
+    def messages(self, **kwargs) -> list:
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.render(**kwargs)}
+        ]
+
+
+def compile_prompts(raw: dict) -> dict:
+    """Validate the YAML prompts and compile them; raises ValueError on a malformed entry."""
+    compiled = {}
+    for name, sections in raw.items():
+        if not isinstance(sections, dict) or not sections.get("system") or not sections.get("user"):
+            raise ValueError(f"Prompt {name!r} needs non-empty 'system' and 'user' sections")
+        if _PLACEHOLDER.search(sections["system"]):
+            raise ValueError(f"Prompt {name!r}: the system prompt must be static, move placeholders to 'user'")
+        compiled[name] = PromptTemplate(name, sections["system"], sections["user"])
+    return compiled
+
+
+def load_prompts(path: str = PROMPTS_PATH) -> dict:
+    import yaml
+    with open(path, "r") as fh:
+        return compile_prompts(yaml.safe_load(fh))
+
+
+def fingerprint(templates) -> str:
+    payload = [[template.name, template.system, template.user] for template in templates]
+    return hashlib.sha256(json.dumps(payload).encode("utf-8")).hexdigest()
@@ -0,0 +1,337 @@
+"""
+Shared rate controller for chat completion calls.
+
+Every model gets a requests-per-minute and a tokens-per-minute token bucket, plus an adaptive
+concurrency limit: additive increase while calls succeed, halved on every 429 (AIMD). A bucket
+only budgets once its quota is known, from EMAIL_RATE_LIMITS or the provider's x-ratelimit-limit-*
+headers; until then the AIMD limit, remaining-* headers and 429s pace the model. The headers
+re-sync the buckets after each response, and 429/5xx/connection errors are retried with
+tenacity, waiting for retry-after when the provider sends one.
+Sync callers (the Edit tab) and async callers (the batch engine) share the same budgets.
+"""
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import deque
+import openai
+from tenacity import AsyncRetrying, Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+# requests and tokens per minute per model, e.g. "gpt-4o-mini=5000:2000000,gpt-4.1=5000:450000";
+# models left out are not budgeted until the provider's headers report their quota
+RATE_LIMITS = os.getenv("EMAIL_RATE_LIMITS", "")
+# bounds of the adaptive per-model concurrency limit
+MAX_CONCURRENCY = int(os.getenv("EMAIL_RATE_MAX_CONCURRENCY", "64"))
+INITIAL_CONCURRENCY = int(os.getenv("EMAIL_RATE_INITIAL_CONCURRENCY", "16"))
+# attempts per call, counting the first one
+MAX_ATTEMPTS = int(os.getenv("EMAIL_RATE_MAX_ATTEMPTS", "6"))
+
+# completion tokens assumed for budgeting when the request sets no max_tokens
+_EXPECTED_COMPLETION_TOKENS = 400
+
+
+def parse_limits(spec: str) -> dict:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, values = item.partition("=")
+        rpm, _, tpm = values.partition(":")
+        limits[model.strip()] = (int(rpm), int(tpm))
+    return limits
+
+
+def parse_duration(value) -> float:
+    """Seconds in a provider duration such as "200ms", "1s" or "6m0s"; None if unparseable."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+def retry_after(headers) -> float:
+    if headers is None:
+        return None
+    if headers.get("retry-after-ms") is not None:
+        return parse_duration(headers["retry-after-ms"] + "ms")
+    return parse_duration(headers.get("retry-after"))
+
+
+def estimate_tokens(messages, params) -> int:
+    # about four characters per token, plus the completion the call may produce
+    prompt = sum(len(message.get("content") or "") for message in messages) // 4
+    return prompt + int(params.get("max_tokens") or params.get("max_completion_tokens") or _EXPECTED_COMPLETION_TOKENS)
+
+
+def _is_retryable(exc) -> bool:
+    if isinstance(exc, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+class TokenBucket():
+    """
+    `rate` units per minute, refilled continuously, holding at most one minute's worth. A None
+    rate is an unknown quota: nothing is budgeted until `sync` learns one.
+    """
+
+    def __init__(self, rate: float = None):
+        self.rate = float(rate) if rate else None
+        self.tokens = self.rate or 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Take `amount` now, going into debt if needed; returns the seconds to wait before using it."""
+        if self.rate is None:
+            return 0.0
+        self._refill(now)
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens * 60 / self.rate
+
+    def settle(self, amount: float):
+        """Give back (or take) `amount` once a call's real usage is known."""
+        if self.rate is not None:
+            self.tokens += amount
+
+    def sync(self, limit, remaining, now):
+        """Adopt the provider's view: its quota and what is left of it."""
+        self._refill(now)
+        if limit:
+            if self.rate is None:
+                self.tokens = float(limit)
+            self.rate = float(limit)
+        if remaining is not None and self.rate is not None:
+            self.tokens = min(self.tokens, float(remaining))
+
+
+class ModelLimiter():
+    """Budgets and AIMD concurrency for one model."""
+
+    def __init__(self, model, rpm, tpm, initial=INITIAL_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.maximum = max(1, maximum)
+        self.limit = float(min(max(1, initial), self.maximum))
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.rate_limited = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    # --- concurrency slots ---
+    def _try_acquire(self, waiter):
+        with self._lock:
+            if not self._waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            self._waiters.append(waiter)
+            return False
+
+    def _wake_waiters(self):
+        # called with the lock held; hands free slots to waiters in FIFO order
+        while self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self._waiters.popleft()()
+
+    def _abandon(self, waiter):
+        # a waiter gave up: either it is still queued, or it was handed a slot it must return
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return
+        self.release()
+
+    def acquire(self):
+        event = threading.Event()
+        if not self._try_acquire(event.set):
+            try:
+                event.wait()
+            except BaseException:
+                self._abandon(event.set)
+                raise
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        if not self._try_acquire(wake):
+            try:
+                await future
+            except asyncio.CancelledError:
+                self._abandon(wake)
+                raise
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._wake_waiters()
+
+    # --- request and token budgets ---
+    def reserve(self, tokens) -> float:
+        """Seconds to wait before sending a request of about `tokens` tokens."""
+        now = time.monotonic()
+        with self._lock:
+            return max(self.paused_until - now, self.requests.reserve(1, now), self.tokens.reserve(tokens, now), 0.0)
+
+    def settle(self, estimated, actual):
+        """Correct the token bucket once the real usage of a call is known."""
+        if actual is None:
+            return
+        with self._lock:
+            self.tokens.settle(estimated - actual)
+
+    def observe(self, headers):
+        """Re-sync budgets from x-ratelimit-* response headers."""
+        if headers is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                bucket.sync(int(limit) if limit else None, int(remaining) if remaining else None, now)
+                if remaining is not None and int(remaining) <= 0:
+                    reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}")) or 1.0
+                    self.paused_until = max(self.paused_until, now + reset)
+
+    # --- AIMD ---
+    def on_success(self):
+        with self._lock:
+            # grows by about one slot per `limit` successful calls
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._wake_waiters()
+
+    def on_rate_limited(self, headers):
+        wait = retry_after(headers) or 1.0
+        with self._lock:
+            self.rate_limited += 1
+            self.limit = max(1.0, self.limit / 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "concurrency_limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "rpm": self.requests.rate,
+                "tpm": self.tokens.rate,
+                "rate_limited": self.rate_limited
+            }
+
+
+def _wait(retry_state):
+    exc = retry_state.outcome.exception()
+    response = getattr(exc, "response", None)
+    seconds = retry_after(response.headers if response is not None else None)
+    if seconds is not None:
+        return seconds
+    return wait_random_exponential(multiplier=0.5, max=20)(retry_state)
+
+
+class RateController():
+    """Process-wide registry of ModelLimiters; wraps each API call in budgeting and retries."""
+
+    def __init__(self, limits=None, max_attempts=MAX_ATTEMPTS):
+        self.limits = {**parse_limits(RATE_LIMITS), **(limits or {})}
+        self.max_attempts = max_attempts
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, model) -> ModelLimiter:
+        with self._lock:
+            if model not in self._limiters:
+                self._limiters[model] = ModelLimiter(model, *self.limits.get(model, (None, None)))
+            return self._limiters[model]
+
+    def _retrying(self, retrying_class):
+        return retrying_class(
+            retry=retry_if_exception(_is_retryable),
+            stop=stop_after_attempt(self.max_attempts),
+            wait=_wait,
+            reraise=True
+        )
+
+    def _after_call(self, limiter, exc=None, raw=None):
+        if isinstance(exc, openai.RateLimitError):
+            limiter.on_rate_limited(exc.response.headers)
+        elif isinstance(exc, openai.APIStatusError):
+            limiter.observe(exc.response.headers)
+        elif raw is not None:
+            limiter.observe(raw.headers)
+            limiter.on_success()
+
+    def call(self, model, messages, params, request):
+        """
+        Run `request()` (one raw-response API call) under the model's budgets, retrying 429/5xx.
+        Returns (raw response, retries taken).
+        """
+        limiter = self.limiter(model)
+        estimate = estimate_tokens(messages, params)
+        for attempt in self._retrying(Retrying):
+            with attempt:
+                limiter.acquire()
+                try:
+                    time.sleep(limiter.reserve(estimate))
+                    try:
+                        raw = request()
+                    except Exception as exc:
+                        self._after_call(limiter, exc=exc)
+                        raise
+                    self._after_call(limiter, raw=raw)
+                finally:
+                    limiter.release()
+        return raw, attempt.retry_state.attempt_number - 1
+
+    async def acall(self, model, messages, params, request):
+        """Async counterpart of `call`; `request()` returns an awaitable."""
+        limiter = self.limiter(model)
+        estimate = estimate_tokens(messages, params)
+        async for attempt in self._retrying(AsyncRetrying):
+            with attempt:
+                await limiter.aacquire()
+                try:
+                    await asyncio.sleep(limiter.reserve(estimate))
+                    try:
+                        raw = await request()
+                    except Exception as exc:
+                        self._after_call(limiter, exc=exc)
+                        raise
+                    self._after_call(limiter, raw=raw)
+                finally:
+                    limiter.release()
+        return raw, attempt.retry_state.attempt_number - 1
+
+    def settle(self, model, messages, params, usage):
+        """Charge the model's token bucket with the real usage of a finished call."""
+        if usage is not None:
+            self.limiter(model).settle(estimate_tokens(messages, params), getattr(usage, "total_tokens", None))
+
+    def stats(self) -> dict:
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {model: limiter.stats() for model, limiter in limiters.items()}
+
+
+_shared_controller = None
+_shared_lock = threading.Lock()
+
+
+def get_rate_controller():
+    global _shared_controller
+    with _shared_lock:
+        if _shared_controller is None:
+            _shared_controller = RateController()
+        return _shared_controller
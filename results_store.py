@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_RESULTS_PATH = os.getenv("EMAIL_RESULTS_PATH", ".cache/results.sqlite3")
+
+
+def input_hash(email: dict) -> str:
+    """Fingerprint of everything from a record that reaches the prompts."""
+    return hashlib.sha256(email.get("content", "").encode("utf-8")).hexdigest()
+
+
+class ResultsStore():
+    """
+    Evaluated records keyed by (dataset, record id, user instruction, model, prompt version).
+
+    A stored record is reused only while the email content it was produced from is unchanged,
+    so re-running a dataset only evaluates emails that are new or edited since the last run.
+    """
+
+    def __init__(self, path: str = DEFAULT_RESULTS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "dataset TEXT NOT NULL, record_id TEXT NOT NULL, user_instruction TEXT NOT NULL, "
+            "model TEXT NOT NULL, prompt_version TEXT NOT NULL, input_hash TEXT NOT NULL, "
+            "record TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (dataset, record_id, user_instruction, model, prompt_version))"
+        )
+        self._conn.commit()
+
+    def lookup(self, dataset: str, model: str, prompt_version: str, emails: list) -> dict:
+        """Stored records for these emails whose inputs are unchanged, by record id."""
+        hashes = {str(email.get("id")): input_hash(email) for email in emails}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT record_id, input_hash, record FROM results "
+                "WHERE dataset = ? AND model = ? AND prompt_version = ?",
+                (dataset, model, prompt_version)
+            ).fetchall()
+        stored = {}
+        for record_id, stored_hash, record in rows:
+            record = json.loads(record)
+            if hashes.get(str(record.get("email_id"))) == stored_hash:
+                stored[record_id] = record
+        return stored
+
+    def save(self, dataset: str, model: str, prompt_version: str, email: dict, records: list):
+        now = time.time()
+        email_hash = input_hash(email)
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO results "
+                "(dataset, record_id, user_instruction, model, prompt_version, input_hash, record, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (dataset, str(record["id"]), record["user_instruction"], model, prompt_version, email_hash,
+                     json.dumps({**record, "email_id": email.get("id")}, ensure_ascii=False), now)
+                    for record in records
+                ]
+            )
+            self._conn.commit()
+
+    def clear(self, dataset: str = None):
+        with self._lock:
+            if dataset is None:
+                self._conn.execute("DELETE FROM results")
+            else:
+                self._conn.execute("DELETE FROM results WHERE dataset = ?", (dataset,))
+            self._conn.commit()
+
+
+_shared_store = None
+_shared_lock = threading.Lock()
+
+
+def get_results_store():
+    global _shared_store
+    with _shared_lock:
+        if _shared_store is None:
+            _shared_store = ResultsStore()
+        return _shared_store
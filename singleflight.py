@@ -0,0 +1,113 @@
+"""
+In-flight request coalescing ("singleflight").
+
+Calls are keyed by their cache key (model, messages and params). While a call for a key is in
+flight, identical calls from any thread or event loop wait for it and share its result instead
+of sending their own request. Streamlit sessions run in threads of one process, so one shared
+instance covers every session.
+"""
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class LeaderInterrupted(Exception):
+    """The leading call was cancelled or interrupted, not failed; waiting callers retry it themselves."""
+
+
+class SingleFlight():
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def begin(self, key):
+        """(future, leader): the leader must run the call and pass its outcome to `end`."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.followers += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def end(self, key, future, result=None, exc=None):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        if exc is not None:
+            # only a failure of the call itself is shared: a leader cancelled by its own job or
+            # rerun (CancelledError, GeneratorExit, ...) must not cancel everyone waiting on it
+            future.set_exception(exc if isinstance(exc, Exception) else LeaderInterrupted())
+        else:
+            future.set_result(result)
+
+    def join(self, key):
+        """
+        (future, None) if the caller leads and must `end` the future, otherwise (None, result of
+        the leader's call). If the leader is interrupted, a waiting caller takes over the call.
+        """
+        while True:
+            future, leader = self.begin(key)
+            if leader:
+                return future, None
+            try:
+                return None, future.result()
+            except LeaderInterrupted:
+                continue
+
+    async def ajoin(self, key):
+        """Async `join`. Waiting works across threads and event loops."""
+        while True:
+            future, leader = self.begin(key)
+            if leader:
+                return future, None
+            try:
+                # shielded: a cancelled waiter must not cancel the shared call for everyone else
+                return None, await asyncio.shield(asyncio.wrap_future(future))
+            except LeaderInterrupted:
+                continue
+
+    def do(self, key, call):
+        """Run `call()` once for all concurrent callers with the same key; returns (result, shared)."""
+        future, result = self.join(key)
+        if future is None:
+            return result, True
+        try:
+            result = call()
+        except BaseException as exc:
+            self.end(key, future, exc=exc)
+            raise
+        self.end(key, future, result)
+        return result, False
+
+    async def ado(self, key, call):
+        """Async `do`; `call()` returns an awaitable."""
+        future, result = await self.ajoin(key)
+        if future is None:
+            return result, True
+        try:
+            result = await call()
+        except BaseException as exc:
+            self.end(key, future, exc=exc)
+            raise
+        self.end(key, future, result)
+        return result, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._calls), "leaders": self.leaders, "followers": self.followers}
+
+
+_shared_flight = None
+_shared_lock = threading.Lock()
+
+
+def get_singleflight():
+    global _shared_flight
+    with _shared_lock:
+        if _shared_flight is None:
+            _shared_flight = SingleFlight()
+        return _shared_flight
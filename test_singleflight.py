@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+import pytest
+from singleflight import SingleFlight
+
+
+def test_followers_share_the_leaders_result():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def call():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "result"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", call)))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=lambda: results.append(flight.do("key", call)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+    assert sorted(results) == [("result", False), ("result", True)]
+    assert len(calls) == 1
+
+
+def test_failures_are_shared():
+    async def main():
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.05)
+            raise ValueError("boom")
+
+        return await asyncio.gather(flight.ado("key", fail), flight.ado("key", fail), return_exceptions=True)
+
+    outcomes = asyncio.run(main())
+    assert all(isinstance(outcome, ValueError) for outcome in outcomes)
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return "result"
+
+        leader = asyncio.ensure_future(flight.ado("key", call))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(flight.ado("key", call))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # the follower takes the call over instead of inheriting the cancellation
+        assert await follower == ("result", False)
+        assert not follower.cancelled()
+        assert len(calls) == 2
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(main())
+
+
+def test_interrupted_sync_leader_hands_over():
+    flight = SingleFlight()
+    started = threading.Event()
+
+    def interrupted():
+        started.set()
+        time.sleep(0.05)
+        raise GeneratorExit()
+
+    results = []
+    leader = threading.Thread(target=lambda: pytest.raises(GeneratorExit, flight.do, "key", interrupted))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=lambda: results.append(flight.do("key", lambda: "result")))
+    follower.start()
+    leader.join()
+    follower.join()
+    assert results == [("result", False)]
+
+
+def test_failed_cache_write_releases_a_stream():
+    from types import SimpleNamespace
+    from generate import GenerateEmail
+
+    class LockedCache():
+        def get(self, key):
+            return None
+
+        def set(self, key, value):
+            raise RuntimeError("database is locked")
+
+    chunk = SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content="edited"))])
+    raw = SimpleNamespace(parse=lambda: iter([chunk]))
+    generator = GenerateEmail.__new__(GenerateEmail)
+    generator.deployment_name, generator.run_id = "gpt-4o-mini", None
+    generator.flight, generator.cache = SingleFlight(), LockedCache()
+    generator.rate = SimpleNamespace(call=lambda *args: (raw, 0), settle=lambda *args: None)
+    generator.metrics = SimpleNamespace(record_usage=lambda *args, **kwargs: None)
+    messages = [{"role": "user", "content": "Hello"}]
+
+    with pytest.raises(RuntimeError):
+        list(generator._stream_api(messages))
+    assert generator.flight.stats()["in_flight"] == 0
+    # a later identical stream leads its own call instead of waiting on the failed one
+    with pytest.raises(RuntimeError):
+        list(generator._stream_api(messages))
+    assert generator.flight.stats()["leaders"] == 2